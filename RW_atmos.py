@@ -11,7 +11,6 @@ from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 from datetime import datetime, timedelta
 
 from scipy import fftpack
-import scipy.integrate as spi
 from obspy.signal.tf_misfit import plot_tfr
 
 from scipy import interpolate
@@ -19,6 +18,7 @@ from sympy import Symbol, symbols, solve
 from sympy.utilities.lambdify import lambdify
 
 from multiprocessing import set_start_method, get_context
+import atexit, tempfile, shutil
 
 ## Local modules
 import mechanisms as mod_mechanisms
@@ -66,7 +66,7 @@ class vertical_velocity():
                         
 class directivity():
 
-        def __init__(self, dep, dr1dz_source, dr2dz_source, kn, r1_source, r2_source):
+        def __init__(self, dep, dr1dz_source, dr2dz_source, kn, r1_source, r2_source, truncated = False):
         
                 self.dep = dep
                 self.dr1dz_source = dr1dz_source
@@ -74,9 +74,13 @@ class directivity():
                 self.kn = kn
                 self.r1_source = r1_source
                 self.r2_source = r2_source
+                self.truncated = truncated # Eigenfunctions only kept over a band of source depths
         
         def compute_directivity(self, phi, M, depth):
         
+                if(self.truncated and (depth/1000. < self.dep[0] or depth/1000. > self.dep[-1])):
+                        sys.exit('Source depth outside of the depths kept for eigenfunctions, see option source_depth_band')
+                
                 idz = np.argmin( abs(self.dep - depth/1000.) )
                 dr1dz_source = self.dr1dz_source[idz]
                 dr2dz_source = self.dr2dz_source[idz]
@@ -90,6 +94,116 @@ class directivity():
                                 - 1j*self.kn*r2_source*(M[3]*np.cos(phi_rot) - M[4]*np.sin(phi_rot)) \
                                 + dr2dz_source*M[0]
 
+## Green's tables of all modes and periods: (mode, period) arrays of the quantities of vertical_velocity, periods following 
+## RW_dispersion.dispersion_table, and the eigenfunctions of directivity on all depths, stored as one row per valid (mode, period) 
+## given by rows, so that periods where a mode does not exist take no space
+class green_table():
+
+        scalars      = ['period', 'r2', 'cphi', 'cg', 'I1', 'kn', 'QR']
+        eigenvectors = ['r1_source', 'r2_source', 'dr1dz_source', 'dr2dz_source']
+
+        def __init__(self, nb_modes, nb_periods):
+        
+                for key in green_table.scalars:
+                        setattr(self, key, np.zeros((nb_modes, nb_periods)))
+                self.valid = np.zeros((nb_modes, nb_periods), dtype=bool)
+                self.rows  = np.full((nb_modes, nb_periods), -1, dtype=int)
+                self.nb_rows = 0
+                self.dep     = np.zeros(0)
+                for key in green_table.eigenvectors:
+                        setattr(self, key, np.zeros((0, 0)))
+                self.truncated = False # Eigenfunctions only kept over a band of source depths
+        
+        def __len__(self):
+        
+                return self.valid.shape[0]
+        
+        ## Depths (km) of the eigenfunctions, allocated with type dtype when the table is still empty
+        def set_depths(self, dep, truncated = False, dtype = np.float64):
+        
+                self.truncated = truncated
+                if len(dep) == len(self.dep) and np.allclose(dep, self.dep) and (self.nb_rows > 0 or self.r1_source.dtype == dtype):
+                        return
+                
+                if self.nb_rows > 0:
+                        sys.exit('Green\'s tables computed at different depths can not be merged')
+                self.dep     = np.array(dep)
+                self.nb_rows = 0
+                for key in green_table.eigenvectors:
+                        setattr(self, key, np.zeros((0, len(dep)), dtype=dtype))
+        
+        ## Allocate the eigenfunctions of nb_rows more (mode, period) at once
+        def reserve(self, nb_rows):
+        
+                extra = self.nb_rows + nb_rows - self.r1_source.shape[0]
+                if extra > 0:
+                        for key in green_table.eigenvectors:
+                                setattr(self, key, np.concatenate([getattr(self, key), np.zeros((extra, len(self.dep)), dtype=getattr(self, key).dtype)]))
+        
+        ## Set the eigenfunctions of modes at periods iperiods from values[key], (len(modes), depth) arrays
+        def set_eigenvectors(self, modes, iperiods, values):
+        
+                rows = self.rows[modes, iperiods]
+                new  = rows < 0
+                self.reserve(new.sum())
+                rows[new] = self.nb_rows + np.arange(new.sum())
+                self.nb_rows += new.sum()
+                self.rows[modes, iperiods] = rows
+                for key in green_table.eigenvectors:
+                        getattr(self, key)[rows] = values[key]
+        
+        ## Copy the periods iperiods_table of table into periods iperiods
+        def set_periods(self, iperiods, table, iperiods_table):
+        
+                self.set_depths(table.dep, table.truncated, table.r1_source.dtype)
+                nb_modes = min(len(self), len(table))
+                for key in green_table.scalars + ['valid']:
+                        getattr(self, key)[:nb_modes, iperiods] = getattr(table, key)[:nb_modes, iperiods_table]
+                
+                modes, ids = np.nonzero(table.valid[:nb_modes, iperiods_table])
+                rows = table.rows[modes, np.asarray(iperiods_table)[ids]]
+                self.set_eigenvectors(modes, np.asarray(iperiods)[ids], {key: getattr(table, key)[rows] for key in green_table.eigenvectors})
+        
+        ## vertical_velocity of one mode and period, [] where the mode does not exist
+        def vertical_velocity(self, imode, iperiod):
+        
+                if not self.valid[imode, iperiod]:
+                        return []
+                
+                kn  = self.kn[imode, iperiod]
+                row = self.rows[imode, iperiod]
+                source = directivity(self.dep, self.dr1dz_source[row], self.dr2dz_source[row], kn, self.r1_source[row], self.r2_source[row], self.truncated)
+                return vertical_velocity(self.period[imode, iperiod], self.r2[imode, iperiod], self.cphi[imode, iperiod], self.cg[imode, iperiod], 
+                                         self.I1[imode, iperiod], kn, self.QR[imode, iperiod], source)
+        
+        def mode_functions(self, imode):
+        
+                return [self.vertical_velocity(imode, iperiod) for iperiod in range(0, self.valid.shape[1])]
+        
+        ## (mode, period) mask of the Green's functions used in spectra, each mode stopping at its first missing period
+        def existing(self):
+        
+                return np.cumprod(self.valid, axis=1).astype(bool)
+        
+        ## Periods of each column, where at least one mode exists
+        def column_periods(self):
+        
+                return self.period.max(axis=0, initial=0.)
+        
+        ## Eigenfunctions of directivity at the depth (km) closest to depth, as (mode, period) arrays (0 where modes do not exist)
+        def source_terms(self, depth):
+        
+                if(self.truncated and (depth < self.dep[0] or depth > self.dep[-1])):
+                        sys.exit('Source depth outside of the depths kept for eigenfunctions, see option source_depth_band')
+                
+                idz   = np.argmin( abs(self.dep - depth) )
+                terms = {}
+                for key in green_table.eigenvectors:
+                        terms[key] = np.zeros(self.valid.shape)
+                        terms[key][self.valid] = getattr(self, key)[self.rows[self.valid], idz]
+                
+                return terms
+
 class RW_forcing():
 
         def __init__(self, options):
@@ -101,8 +215,7 @@ class RW_forcing():
                 self.set_global_folder(options['global_folder'])
                 
                 ## Attributes containing seismic/acoustic spectra
-                self.directivity = [ [ [] for aa in range(0, len(self.f_tab)) ] for bb in range(0, options['nb_modes'][1]) ]
-                self.uz          = [ [ [] for aa in range(0, len(self.f_tab)) ] for bb in range(0, options['nb_modes'][1]) ]
+                self.table = green_table(options['nb_modes'][1], len(self.f_tab))
                 
                 ## Extract seismic model for later plots
                 self.extract_seismic_parameters(options)
@@ -179,71 +292,106 @@ class RW_forcing():
                 else:
                         sys.exit('Source time function "'+self.stf+'" not recognized!')
         
-        def add_one_period(self, period, iperiod, current_struct, rho, orig_b1, orig_b2, d_b1_dz, d_b2_dz, kmode, dep):
+        ## Green's tables of all modes and periods, built on demand from self.table
+        @property
+        def uz(self):
         
-                uz    = []
-                freqa = []
-                for imode in range(0, min(len(current_struct),orig_b1.shape[1])):
-                
-                        cphi = current_struct[imode]['cphi'][iperiod]
-                        cg   = current_struct[imode]['cg'][iperiod]
-                        r2   = orig_b2[:,imode]
-                        r1   = orig_b1[:,imode]
-                        kn   = kmode[:,imode]
-                        d_r2_dz = d_b2_dz[:,imode]
-                        d_r1_dz = d_b1_dz[:,imode]
-                        
-                        I1   = 0.5*spi.simps(rho[:]*( r1**2 + r2**2 ), dep[:])
-                        
-                        kn = kn[0]
-                        self.directivity[imode][iperiod] = directivity(dep, d_r1_dz, d_r2_dz, kn, r1, r2)
-                        
-                        r2 = r2[0]
-                        r1 = r1[0]
-                        
-                        ## Compute quality factor
-                        #QR  = spi.simps( (2./Qp[:])*(lamda[:] + 2*mu[:])*( kn*r1 + d_r2_dz )**2, dep[:])
-                        #QR += spi.simps( (2.*mu[:]/Qs[:])*(( kn*r2 + d_r1_dz )**2 - 4*kn*r1*d_r2_dz ), dep[:])
-                        #QR *= 1./(4.*(kn**2)*cg*cphi*I1)
-                        QR = current_struct[imode]['QR'][iperiod]
-                        
-                        ## Store Green's functions for an arbitrary moment tensor
-                        self.uz[imode][iperiod]        = vertical_velocity(period, r2, cphi, cg, I1, kn, QR, self.directivity[imode][iperiod])
-                        
-        def compute_RW_one_mode(self, imode, r, phi, type = 'RW', unknown = 'd', dimension_seismic = 3):
+                return [self.table.mode_functions(imode) for imode in range(0, len(self.table))]
         
-                ## Source depth
-                depth = self.zsource
+        ## Store the Green's functions of modes at periods (numbers iperiods of current_struct), one per row of the eigenfunctions 
+        ## r1, r2 and their depth derivatives given as (row, depth) arrays. I1 and the surface value r2_surface are computed on all 
+        ## depths when eigenfunctions are truncated
+        def add_periods(self, periods, iperiods, modes, current_struct, r1, r2, d_r1_dz, d_r2_dz, kmode, dep, I1, r2_surface, truncated = False):
         
-                uz_tab = []
-                f_tab  = []
-                #print('Compute mode: ', imode)
-                for iuz in self.uz[imode]:
-                     
-                     if(iuz):
-                             M = self.source_spectrum(iuz.period)
-                             f  = 1./iuz.period  
-                             
-                             f_tab.append( f )
-                             uz = iuz.compute_veloc(r, phi, M, depth, unknown, dimension_seismic)
-                             
-                             # If 1d mesh passed we just append
-                             if(phi.shape[0] == phi.size):
-                                uz_tab.append( uz.reshape(r.size) )
-
-                             # If 2d r/phi mesh passed
-                             # Create a 1d array with increments in phi and then r
-                             else:   
-                                uz_tab.append( uz.reshape(r.shape[1]*r.shape[0],) )
+                table = self.table
+                table.set_depths(dep, truncated, r1.dtype)
+                keep  = modes < min(len(current_struct), len(table))
+                modes, iperiods = modes[keep], iperiods[keep]
+                
+                ## Dispersion characteristics of all modes at these periods (see RW_dispersion.dispersion_table)
+                for key in ['cphi', 'cg', 'QR']:
+                        getattr(table, key)[modes, iperiods] = getattr(current_struct, key)[modes, iperiods]
+                for key, values in zip(['period', 'kn', 'I1', 'r2'], [periods, kmode, I1, r2_surface]):
+                        getattr(table, key)[modes, iperiods] = values[keep]
+                table.valid[modes, iperiods] = True
+                
+                ## Compute quality factor
+                #QR  = spi.simps( (2./Qp[:])*(lamda[:] + 2*mu[:])*( kn*r1 + d_r2_dz )**2, dep[:])
+                #QR += spi.simps( (2.*mu[:]/Qs[:])*(( kn*r2 + d_r1_dz )**2 - 4*kn*r1*d_r2_dz ), dep[:])
+                #QR *= 1./(4.*(kn**2)*cg*cphi*I1)
+                
+                ## Eigenfunctions at all source depths, for an arbitrary moment tensor
+                table.set_eigenvectors(modes, iperiods, {key: values[keep] for key, values in zip(green_table.eigenvectors, [r1, r2, d_r1_dz, d_r2_dz])})
+                        
+        ## Terms of the spectra of modes (all modes by default) that do not depend on the receivers, one row per (mode, period)
+        ## sorted by period then mode, see add_spectra. Columns iperiods of self.table are those where at least one mode exists
+        def spectra_terms(self, modes = None, unknown = 'd', dimension_seismic = 3):
+        
+                table    = self.table
+                existing = table.existing()
+                iperiods = np.where(existing.any(axis=0))[0]
+                selected = np.zeros(existing.shape, dtype=bool)
+                selected[np.arange(len(table)) if modes is None else np.asarray(modes, dtype=int)] = True
+                
+                ## Rows sorted by period then mode so that modes are summed in the same order at all periods
+                icols, imodes = np.nonzero((existing & selected)[:, iperiods].T)
+                cols   = iperiods[icols]
+                period = table.period[imodes, cols]
+                kn     = table.kn[imodes, cols]
+                cphi   = table.cphi[imodes, cols]
+                terms  = {key: values[imodes, cols] for key, values in table.source_terms(self.zsource/1000.).items()}
+                M      = np.array([self.source_spectrum(period_) for period_ in table.column_periods()[iperiods]]).reshape(len(iperiods), -1)[icols]
+                
+                comp_deriv = -np.pi*2.*1j/period if unknown == 'v' else np.ones(len(period))
+                comp_deriv = (-np.pi*2.*1j/period)*comp_deriv if unknown == 'a' else comp_deriv
+                
+                ## Amplitude of each mode and power of the radial decay
+                if(dimension_seismic == 3):
+                        amplitude = comp_deriv*(table.r2[imodes, cols]/(8*cphi*table.cg[imodes, cols]*table.I1[imodes, cols]))*np.sqrt(2./(np.pi*kn))*np.exp(1j*np.pi/4.)
+                        decay     = 0.5
+                elif(dimension_seismic == 2):
+                        amplitude = 1e3*comp_deriv*(table.r2[imodes, cols]/(4*cphi*table.cg[imodes, cols]*table.I1[imodes, cols]))*(1./kn)*np.exp(1j*np.pi/2.)
+                        decay     = 0.
+                else:
+                        sys.exit('Seismic dimension not recognized!')
+                
+                ## Directivity (see directivity.compute_directivity) on the basis 1, cos^2, sin*cos, sin^2, cos, sin of the receiver azimuths
+                horizontal = 1j*(terms['dr1dz_source'] - kn*terms['r2_source'])
+                coefs = np.array([terms['dr2dz_source']*M[:,0], kn*terms['r1_source']*M[:,1], -2.*kn*terms['r1_source']*M[:,5], 
+                                  kn*terms['r1_source']*M[:,2], horizontal*M[:,3], -horizontal*M[:,4]]).T*amplitude.reshape(-1,1)
+                
+                ## Propagation with attenuation (see vertical_velocity.add_attenuation)
+                wavenumber = 1j*kn - np.pi/(cphi*table.QR[imodes, cols]*period)
                 
-                     else:
-                        break
+                return {'iperiods': iperiods, 'icols': icols, 'coefs': coefs, 'wavenumber': wavenumber, 'decay': np.array([decay])}
+        
+        ## Spectra of modes (all modes by default) at the receivers (r (km), phi), i.e. the sum over modes of vertical_velocity.compute_veloc 
+        ## Returns the columns iperiods of self.table where at least one mode exists and the (period, receiver) array of spectra, the 
+        ## receivers being those of the broadcast of r and phi
+        def compute_spectra(self, r, phi, modes = None, unknown = 'd', dimension_seismic = 3):
+        
+                terms  = self.spectra_terms(modes, unknown, dimension_seismic)
+                r, phi = receivers(r, phi)
+                spectra = np.zeros((len(terms['iperiods']), len(r)), dtype=complex)
+                add_spectra(terms, r, phi, spectra)
                 
-                response         = pd.DataFrame(np.array(uz_tab)) # Transform list into dataframe
-                response.columns = np.arange(0, phi.size)
-                response['f']    = np.array(f_tab) 
+                return terms['iperiods'], spectra
+        
+        ## Spectra of compute_spectra as a dataframe with one column per receiver and the frequencies in column 'f'
+        def spectra_dataframe(self, iperiods, spectra):
+        
+                response         = pd.DataFrame(spectra)
+                response.columns = np.arange(0, spectra.shape[1])
+                response['f']    = 1./self.table.column_periods()[iperiods]
                 
                 return response
+        
+        def compute_RW_one_mode(self, imode, r, phi, type = 'RW', unknown = 'd', dimension_seismic = 3):
+        
+                iperiods, spectra = self.compute_spectra(r, phi, [imode], unknown, dimension_seismic)
+                keep = self.table.existing()[imode, iperiods]
+                
+                return self.spectra_dataframe(iperiods[keep], spectra[keep])
 
         def extract_seismic_parameters(self, options):
         
@@ -252,63 +400,35 @@ class RW_forcing():
                 
         def local_mode(self, r, phi, type, unknown, dimension_seismic, modes):
                 
-            for imode_num, imode in enumerate(modes):
-            
-                    #print('Computing mode', imode)
-            
-                    response_RW_temp = self.compute_RW_one_mode(imode, r, phi, type, unknown, dimension_seismic)
-                    if(imode_num == 0):
-                            response_RW = response_RW_temp.copy()
-                    else:
-
-                            ## Concatenate dataframes with same freq.
-                            ## we can not use pd.concat since it is too slow for complex numbers
-                            response_RW = utils.concat_df_complex(response_RW, response_RW_temp, 'f')
-                    
-            return response_RW
+            return self.spectra_dataframe(*self.compute_spectra(r, phi, modes, unknown, dimension_seismic))
         
+        ## Spectra are split into (period block, receiver block) tasks of similar cost, see spectra_tasks, computed by the workers of 
+        ## the persistent pool of get_spectra_pool. Only the terms of spectra_terms and the receivers are shared with the workers, 
+        ## which write their block of spectra in a shared array
+        spectra_workers = os.cpu_count() or 1 # Number of processes of the pool
+        spectra_tasks_per_worker = 4 # Tasks per worker, to balance errors in the cost estimate
+        spectra_min_cost = 2**20 # Smallest number of (mode, period, receiver) values of a task
         def response_RW_all_modes(self, r, phi, type = 'RW', unknown = 'd', mode_max = -1, dimension_seismic = 3):
         
-            import multiprocessing as mp
-            from functools import partial
-    
-            mode_max = len(self.uz) if mode_max == -1 else mode_max
-            
-            parallel = True
-            
-            if not parallel:
-                    for imode in range(0, mode_max):
-                    
-                            #print('Computing mode', imode)
-                    
-                            response_RW_temp = self.compute_RW_one_mode(imode, r, phi, type, unknown, dimension_seismic)
-                            if(imode == 0):
-                                    response_RW = response_RW_temp.copy()
-                            else:
-
-                                    ## Concatenate dataframes with same freq.
-                                    ## we can not use pd.concat since it is too slow for complex numbers
-                                    response_RW = utils.concat_df_complex(response_RW, response_RW_temp, 'f')
+            mode_max = len(self.table) if mode_max == -1 else mode_max
+            terms    = self.spectra_terms(range(0, mode_max), unknown, dimension_seismic)
+            r, phi   = receivers(r, phi)
             
-            else:          
-                    modes = [key for key in range(0, mode_max)]
-                    N = 16
-                    list_of_lists = [sublist for sublist in np.array_split(modes, N) if sublist.size>0]
-                    N = len(list_of_lists)
-                    
-                    local_mode_partial = partial(self.local_mode, r, phi, type, unknown, dimension_seismic)
-                                
-                    if self.use_spawn:
-                            with get_context("spawn").Pool(processes = N) as p:
-                                    results = p.map(local_mode_partial, list_of_lists)
-                    else:
-                            with mp.Pool(processes = N) as p:
-                                    results = p.map(local_mode_partial, list_of_lists)
+            tasks = spectra_tasks(terms['icols'], len(r), RW_forcing.spectra_workers*RW_forcing.spectra_tasks_per_worker, RW_forcing.spectra_min_cost)
+            if RW_forcing.spectra_workers < 2 or len(tasks) < 2:
+                    spectra = np.zeros((len(terms['iperiods']), len(r)), dtype=complex)
+                    add_spectra(terms, r, phi, spectra)
+                    return self.spectra_dataframe(terms['iperiods'], spectra)
             
-                    response_RW = results[0]
-                    for imode, result in enumerate(results): response_RW = utils.concat_df_complex(response_RW, result, 'f');
+            pool   = get_spectra_pool(RW_forcing.spectra_workers, self.use_spawn)
+            shared = shared_arrays(dict(terms, r=r, phi=phi), {'spectra': ((len(terms['iperiods']), len(r)), complex)})
+            try:
+                    pool.map(spectra_worker, [(shared.specs,) + task for task in tasks], chunksize=1)
+                    spectra = np.array(shared.arrays['spectra'])
+            finally:
+                    shared.close()
                     
-            return response_RW  
+            return self.spectra_dataframe(terms['iperiods'], spectra)
                 
         def response_perturbed_solution(self, x, r, phi, type = 'RW', unknown = 'd', mode_max = -1, dimension_seismic = 3, type_opti='min'):
         
@@ -327,17 +447,8 @@ class RW_forcing():
             mechanism['M'] = mt.m6_up_south_east()
             self.update_mechanism(mechanism)
     
-            mode_max = len(self.uz) if mode_max == -1 else mode_max
-            for imode in range(0, mode_max):
-            
-                    response_RW_temp = self.compute_RW_one_mode(imode, r, phi, type, unknown, dimension_seismic)
-                    if(imode == 0):
-                            response_RW = response_RW_temp.copy()
-                    else:
-
-                            ## Concatenate dataframes with same freq.
-                            ## we can not use pd.concat since it is too slow for complex numbers
-                            response_RW = utils.concat_df_complex(response_RW, response_RW_temp, 'f')
+            mode_max = len(self.table) if mode_max == -1 else mode_max
+            response_RW = self.local_mode(r, phi, type, unknown, dimension_seismic, range(0, mode_max))
                             
             self.update_mechanism(mechanism_save)
             
@@ -386,6 +497,106 @@ class RW_forcing():
             
             return (t, ifft_RW)
 
+## Receivers of the broadcast of r and phi, as 1d arrays
+def receivers(r, phi):
+
+        r, phi = np.broadcast_arrays(r, phi)
+        return r.ravel(), phi.ravel()
+
+## Add to spectra (period, receiver) the spectra at receivers (r, phi) from the terms of RW_forcing.spectra_terms
+## Receivers are processed in blocks of about spectra_block_size values
+spectra_block_size = 2**20
+def add_spectra(terms, r, phi, spectra):
+
+        icols = terms['icols']
+        if len(icols) == 0:
+                return
+        
+        starts = np.concatenate([[0], np.where(np.diff(icols) > 0)[0] + 1])
+        basis  = np.array([np.ones(len(phi)), np.cos(phi)**2, np.sin(phi)*np.cos(phi), np.sin(phi)**2, np.cos(phi), np.sin(phi)]).T*(r**(-terms['decay'][0])).reshape(-1,1)
+        nb_block = max(1, spectra_block_size//len(icols))
+        for start in range(0, len(r), nb_block):
+                block = slice(start, min(start + nb_block, len(r)))
+                values = np.dot(terms['coefs'], basis[block].T)*np.exp(np.outer(terms['wavenumber'], r[block]))
+                spectra[icols[starts], block] += np.add.reduceat(values, starts, axis=0)
+
+## Tasks (first row, last row, first receiver, last receiver) of add_spectra for the rows of icols (mode, period) of
+## RW_forcing.spectra_terms and nb_receivers receivers. The cost of a task is its number of rows times its number of receivers,
+## so that periods with few modes weigh less. Rows are split into period blocks of similar number of rows, each period being
+## in a single block so that modes are always summed in the same order, and receivers into blocks of similar size
+def spectra_tasks(icols, nb_receivers, nb_tasks, min_cost):
+
+        nb_rows  = len(icols)
+        if nb_rows == 0 or nb_receivers == 0:
+                return []
+        
+        nb_tasks = max(1, min(nb_tasks, (nb_rows*nb_receivers)//max(min_cost, 1)))
+        bounds   = np.concatenate([[0], np.where(np.diff(icols) > 0)[0] + 1, [nb_rows]])
+        
+        ## Period blocks first, then receiver blocks with the remaining tasks
+        nb_period_blocks = min(nb_tasks, len(bounds)-1)
+        rows = np.unique(bounds[np.searchsorted(bounds, np.linspace(0, nb_rows, nb_period_blocks+1))])
+        nb_receiver_blocks = max(1, min(nb_tasks//(len(rows)-1), nb_receivers))
+        receivers = np.linspace(0, nb_receivers, nb_receiver_blocks+1).astype(int)
+        
+        ## Most expensive tasks first
+        tasks = [(row_start, row_stop, start, stop) for row_start, row_stop in zip(rows[:-1], rows[1:]) for start, stop in zip(receivers[:-1], receivers[1:])]
+        return sorted(tasks, key=lambda task: -(task[1]-task[0])*(task[3]-task[2]))
+
+## Arrays shared between processes through files in memory (/dev/shm when available), given as a dict of arrays and a dict of
+## (shape, dtype) of arrays to allocate with zeros. Other processes open them from specs with open_shared_arrays
+class shared_arrays():
+
+        def __init__(self, arrays, outputs = {}):
+        
+                self.folder = tempfile.mkdtemp(prefix='RW_spectra_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+                self.specs  = {}
+                for key, value in list(arrays.items()) + list(outputs.items()):
+                        shape, dtype = (value.shape, value.dtype) if key in arrays else value
+                        self.specs[key] = (os.path.join(self.folder, key), shape, np.dtype(dtype).str)
+                self.arrays = open_shared_arrays(self.specs, 'w+')
+                for key, value in arrays.items():
+                        self.arrays[key][:] = value
+        
+        def close(self):
+        
+                self.arrays = {}
+                shutil.rmtree(self.folder, ignore_errors=True)
+
+def open_shared_arrays(specs, mode = 'r+'):
+
+        return {key: np.memmap(name, dtype=dtype, mode=mode, shape=shape) if np.prod(shape) > 0 else np.zeros(shape, dtype=dtype) for key, (name, shape, dtype) in specs.items()}
+
+## Spectra of the rows row_start to row_stop of the terms at receivers start to stop, written in the shared arrays of specs
+def spectra_worker(task):
+
+        specs, row_start, row_stop, start, stop = task
+        arrays = open_shared_arrays(specs)
+        terms  = {key: arrays[key][row_start:row_stop] for key in ['icols', 'coefs', 'wavenumber']}
+        terms['decay'] = arrays['decay']
+        add_spectra(terms, arrays['r'][start:stop], arrays['phi'][start:stop], arrays['spectra'][:, start:stop])
+        arrays['spectra'].flush()
+
+## Pool of processes kept between calls of RW_forcing.response_RW_all_modes, closed at exit
+spectra_pool = {}
+def get_spectra_pool(nb_workers, use_spawn):
+
+        if spectra_pool.get('key') != (nb_workers, use_spawn):
+                close_spectra_pool()
+                context = get_context("spawn") if use_spawn else get_context()
+                spectra_pool['pool'] = context.Pool(processes = nb_workers)
+                spectra_pool['key']  = (nb_workers, use_spawn)
+        
+        return spectra_pool['pool']
+
+def close_spectra_pool():
+
+        if 'pool' in spectra_pool:
+                spectra_pool.pop('pool').terminate()
+                spectra_pool.pop('key')
+
+atexit.register(close_spectra_pool)
+
 def generate_one_timeseries(t, Mz_t, RW_Mz_t, comp, iz, iy, ix, stat, options):
 
     ## Save waveforms     
@@ -6,7 +6,14 @@ import matplotlib
 import matplotlib.pyplot as plt
 from pdb import set_trace as bp
 import sys 
+import glob
+import hashlib
+import pickle
+import shutil
+import subprocess
+import tempfile
 from multiprocessing import set_start_method, get_context
+import scipy.integrate as spi
 
 ## Local modules
 import velocity_models, utils, RW_atmos
@@ -22,27 +29,39 @@ matplotlib.use('Agg')
 ## Generate velocity and option files to run earthsr
 def generate_model_for_earthsr(side, options):
 
-        format_header = '%d %d %12.12f \n'
-        format_string = '%12.12f %12.12f %12.12f %12.12f %12.12f %12.12f \n'
-        format_phase  = '%12.12f %12.12f %d %d \n'
-        format_freq   = '%d %d %12.12f %12.12f \n'
-        
         ## Write input files - LEFT AND RIGHT
         #for nside in range(1,3):
             
-        side['name']   = options['global_folder'] + '/input_code_earthsr' 
-    
-        ## Generate link for dispersion code
-        os.system('rm ' + './input_code_earthsr')
-        os.system('ln ' + '-s ' + side['name'])
+        side['name']   = options['global_folder'] + 'input_code_earthsr' 
+
+        write_earthsr_input(side['name'], side, options)
 
+## Write the earthsr input file name for the first options['nb_layers'] layers of the model and the frequencies in options
+## The half space takes the properties of layer ihalf_space of side, by default the layer above it
+def write_earthsr_input(name, side, options, ihalf_space = None):
+
+        format_header = '%d %d %12.12f %d %d %d \n'
+        format_string = '%12.12f %12.12f %12.12f %12.12f %12.12f %12.12f \n'
+        format_phase  = '%12.12f %12.12f %d %d \n'
+        format_freq   = '%d %d %12.12f %12.12f \n'
+        
+        ## Trial phase velocities of the root search, read by earthsr from warm.<input file>
+        warm = warm_start_enabled(options)
+        if warm:
+                cwarm = warm_start_phase_velocities(options)
+                with open(os.path.join(os.path.dirname(name), 'warm.' + os.path.basename(name)), 'w') as f:
+                        f.write('%d %d %12.12f \n' % (cwarm.shape[0], cwarm.shape[1], options['warm_start_tol']))
+                        np.savetxt(f, cwarm, fmt='%12.12f')
+        
         ## Open file
-        with open(side['name'], 'w') as f:
+        with open(name, 'w') as f:
         
-                f.write(format_header % (options['nb_layers'], options['earth_flattening'], options['ref_period']))
+                f.write(format_header % (options['nb_layers'], options['earth_flattening'], options['ref_period'], int(options['eigen_binary']), int(options['earthsr_derivatives']), int(warm)))
                 for l in range(0, options['nb_layers']-1):
                         f.write(format_string % (options['h'][l], side['vp'][l], side['vs'][l], side['rho'][l], side['Qa'][l], side['Qb'][l]))
                 hend = 0.
+                if ihalf_space is not None:
+                        l = ihalf_space
                 f.write(format_string % (hend, side['vp'][l],side['vs'][l], side['rho'][l], side['Qa'][l], side['Qb'][l])) 
                 # Surface wave type.  1 = Rayleigh; <>1 Love.  In this case we choose the Rayleigh option
                 f.write('%d\n' % (options['type_wave'] ))
@@ -62,16 +81,113 @@ def generate_model_for_earthsr(side, options):
                 f.write('%d \n' % (options['Loop']))
 
 import read_earth_io as reo
-def local_collect(title, N, periods):
+def local_collect(title, model, dtype, periods_and_blocks):
 
-        return (reo.read_egnfile_allper(title, periods, N), periods)
+        periods, blocks = periods_and_blocks
+        return (reo.read_egnfile_blocks(title, model, blocks, dtype), periods)
 
-## Collect eigenfunctions and derivatives from earthsr
-def get_eigenfunctions(current_struct, options):
+## Parse eigenfunctions of each period from the earthsr output in folder, split over N workers
+def collect_eigenfunctions(folder, periods, N, dtype, options):
 
         import multiprocessing as mp
         from functools import partial
+
+        ## Locate the blocks of each period with a single pass over the eigenfunction file
+        ## Workers then only read back the blocks of their own periods
+        name_eigen    = folder + 'eigen.input_code_earthsr'
+        model, blocks = reo.scan_egnfile(name_eigen, periods)
+        list_of_lists = [(periods[ids], [blocks[id] for id in ids]) for ids in np.array_split(np.arange(len(periods)), N)]
+
+        local_collect_partial = partial(local_collect, name_eigen, model, dtype)
+
+        if N == 1:
+                results = [local_collect_partial(list_of_lists[0])]
+        else:
+                if options['USE_SPAWN_MPI']:
+                        with get_context("spawn").Pool(processes = N) as p:
+                                results = p.map(local_collect_partial, list_of_lists)
+                else:
+                        with mp.Pool(processes = N) as p:
+                                results = p.map(local_collect_partial, list_of_lists)
+
+        return results
+
+## Slice of the depths dep (km) covering depth_band = [min, max] (km), with one more depth on each side
+def depth_band_slice(dep, depth_band):
+
+        ilow  = max(np.searchsorted(dep, depth_band[0], side='left') - 1, 0)
+        ihigh = min(np.searchsorted(dep, depth_band[1], side='right') + 1, len(dep))
+        return slice(ilow, ihigh)
+
+## Read eigenfunctions at the given periods from the earthsr output in folder, parsed over N workers if needed
+def read_eigenfunctions(folder, periods, N, dtype, options):
+
+        ## Eigenfunctions already parsed for the same earthsr input and periods are reloaded from the cache
+        cache_folder = ''
+        if options['eigen_cache_dir']:
+                key = reo.egn_cache_key(folder + 'input_code_earthsr', periods, dtype)
+                cache_folder = os.path.join(options['eigen_cache_dir'], key)
+        
+        if options['eigen_binary']:
+                ## earthsr wrote the eigenfunctions of all layers in binary form, they are memory-mapped instead of parsed
+                name_bin = folder + 'eigenbin.input_code_earthsr'
+                if not os.path.isfile(name_bin):
+                        sys.exit('No binary eigenfunction file in ' + folder + ', earthsr has to be rebuilt (make earthsr) to use eigen_binary')
+                results = [(reo.read_egnfile_bin(name_bin, periods, dtype), periods)]
+        elif cache_folder and os.path.isdir(cache_folder):
+                results = [(reo.read_egn_cache(cache_folder), periods)]
+        else:
+                results = collect_eigenfunctions(folder, periods, N, dtype, options)
+                if cache_folder:
+                        os.makedirs(options['eigen_cache_dir'], exist_ok=True)
+                        reo.save_egn_cache(cache_folder, [result[0] for result in results])
+        
+        return results
+
+## Add to Green_RW the Green's functions of the periods read in reoobj, the first one being period number offset of 
+## options['f_tab'] (ascending periods), as indexed in current_struct
+green_block_size = 2**20
+def store_eigenfunctions(Green_RW, current_struct, reoobj, periods, offset, options):
+
+        ## Eigenfunctions of the valid (mode, period) of blocks of periods are gathered as rows of (row, depth) arrays, of about 
+        ## green_block_size values
+        periods  = np.asarray(periods)
+        nb_modes = min(reoobj.uzmat.shape[2], len(current_struct))
+        nb_block = max(1, green_block_size//max(len(reoobj.dep)*nb_modes, 1))
+        band     = depth_band_slice(reoobj.dep, options['source_depth_band']) if options['source_depth_band'] else slice(None)
+        dep      = reoobj.dep[band]
+        mu       = reoobj.mu[band].reshape(1,-1)
+        lamda    = reoobj.lamda[band].reshape(1,-1)
+        rho      = reoobj.rho.reshape(1,-1)
+        Green_RW.table.set_depths(dep, bool(options['source_depth_band']), reoobj.uzmat.dtype)
+        Green_RW.table.reserve(np.minimum(reoobj.nmodes, nb_modes).sum())
+        for start in range(0, len(periods), nb_block):
         
+                block = slice(start, min(start + nb_block, len(periods)))
+                valid = np.arange(nb_modes).reshape(1,nb_modes) < reoobj.nmodes[block].reshape(-1,1)
+                ids, modes = np.nonzero(valid)
+                orig_b1, orig_b2, orig_b3, orig_b4 = [np.transpose(ymat[block,:,:nb_modes], (0,2,1))[valid] for ymat in [reoobj.uzmat, reoobj.urmat, reoobj.tzmat, reoobj.trmat]]
+                kmode   = reoobj.wavnum[block,:nb_modes][valid].reshape(-1,1)
+                omega   = (2*np.pi/periods[block][ids]).reshape(-1,1)
+                
+                ## I1 and surface values are computed on all depths, then only depths around the sources are kept
+                I1_modes   = 0.5*spi.simpson(rho*( orig_b1**2 + orig_b2**2 ), x=reoobj.dep, axis=1)
+                r2_surface = orig_b2[:,0]
+                orig_b1, orig_b2, orig_b3, orig_b4 = orig_b1[:,band], orig_b2[:,band], orig_b3[:,band], orig_b4[:,band]
+                
+                # Eq. (7.28) Aki-Richards
+                # r1 = b2 r2 = b1
+                # r3 = b4 r4 = b3
+                d_b2_dz = (omega*orig_b4-np.multiply(mu*kmode,orig_b1))/mu # numpy.multiply does element wise array multiplication
+                d_b1_dz = (np.multiply(lamda*kmode,orig_b2)+omega*orig_b3)/(lamda+2*mu)
+                
+                ## Construct Green's functions for these periods
+                Green_RW.add_periods(periods[block][ids], offset + start + ids, modes, current_struct, orig_b1, orig_b2, d_b1_dz, d_b2_dz, 
+                                     kmode[:,0], dep, I1_modes, r2_surface, bool(options['source_depth_band']))
+
+## Collect eigenfunctions and derivatives from earthsr
+def get_eigenfunctions(current_struct, options, eigen_in_process = None):
+
         ## Construct RW spectrum object 
         Green_RW = RW_atmos.RW_forcing(options)
 
@@ -82,9 +198,9 @@ def get_eigenfunctions(current_struct, options):
         freqa_tab = [[] for ii in range(0,options['nb_modes'][1]+1) ]
         
         N = 16
-        list_of_lists = np.array_split(periods, N)
         
-        local_collect_partial = partial(local_collect, options['global_folder'] + 'eigen.input_code_earthsr', N)
+        ## Eigenfunctions can be stored in single precision to halve memory
+        dtype = np.float32 if options['eigen_float32'] else np.float64
         
         ## Setup progress bar
         toolbar_width = 40
@@ -93,21 +209,27 @@ def get_eigenfunctions(current_struct, options):
         sys.stdout.flush()
         #sys.stdout.write("\b" * (toolbar_width+1)) # return to start of line, after '['
         
-        if N == 1:
-                results = [local_collect_partial(periods)]
+        if eigen_in_process is not None:
+                ## Eigenfunctions of all layers returned by the in-process earthsr, see compute_dispersion_in_process
+                results = [(reo.read_egnfile_bin(eigen_in_process, periods, dtype), periods)]
+                N = 1
+        elif options['earthsr_bands'] > 1:
+                ## earthsr ran over frequency bands, see compute_dispersion_in_bands
+                ## Bands computed with shallower models are extended to the depths of the deepest one
+                results = []
+                for iband, ids in enumerate(frequency_bands(options)):
+                        results += read_eigenfunctions(band_folder(options, iband), periods[ids], N, dtype, options)
+                reo.extend_egn_depths([result[0] for result in results])
+                N = len(results)
         else:
-                if options['USE_SPAWN_MPI']:
-                        with get_context("spawn").Pool(processes = N) as p:
-                                results = p.map(local_collect_partial, list_of_lists)
-                else:
-                        with mp.Pool(processes = N) as p:
-                                results = p.map(local_collect_partial, list_of_lists)
+                results = read_eigenfunctions(options['global_folder'], periods, N, dtype, options)
+                N = len(results)
                                 
         sys.stdout.write("] Done\n")
         
         ## Setup progress bar
         toolbar_width = 40
-        total_length  = len(periods) * N
+        total_length  = len(periods)
         sys.stdout.write("Store eigenfunctions: [%s]" % (" " * toolbar_width))
         sys.stdout.flush()
         id_stat = 0
@@ -118,112 +240,886 @@ def get_eigenfunctions(current_struct, options):
             
             reoobj   = reoobj_[0]
             periods_ = reoobj_[1]
-            for iperiod, period in enumerate(periods_):
-        
-                iperiod_ = offset + iperiod
-        
-                #reoobj=reo.read_egnfile_per(options['global_folder'] + 'eigen.input_code_earthsr', period)
-                
-                dep     = reoobj.dep
-                omega   = 2*np.pi/period
-                
-                orig_b1 = reoobj.uzmat[iperiod]
-                orig_b2 = reoobj.urmat[iperiod]
-                orig_b3 = reoobj.tzmat[iperiod]
-                orig_b4 = reoobj.trmat[iperiod]
-                kmode   = reoobj.wavnum[iperiod].reshape(1,len(reoobj.wavnum[iperiod]))
-                        
-                origdep = reoobj.dep
-                nmodes  = orig_b1.shape[1]
-                mu      = reoobj.mu.reshape(len(reoobj.mu),1)
-                lamda   = reoobj.lamda.reshape(len(reoobj.mu),1)
-                rho     = reoobj.rho
-                kmu    = np.dot(mu,kmode)
-                klamda = np.dot(lamda,kmode)
-                
-                # Eq. (7.28) Aki-Richards
-                # r1 = b2 r2 = b1
-                # r3 = b4 r4 = b3
-                d_b2_dz = (omega*orig_b4-np.multiply(kmu,orig_b1))/mu # numpy.multiply does element wise array multiplication
-                d_b1_dz = (np.multiply(klamda,orig_b2)+omega*orig_b3)/(lamda+2*mu)
-                dxz     = np.gradient(orig_b2[:,0])
-                dzz     = np.gradient(orig_b1[:,0])
-                
-                ## Construct Green's function for a given period 
-                Green_RW.add_one_period(period, iperiod_, current_struct, rho, orig_b1, orig_b2, d_b1_dz, d_b2_dz, kmode, dep)
-                
-                ## Update progress bar
-                id_stat += 1
-                if(int(toolbar_width*id_stat/total_length) > cptbar):
-                        cptbar = int(toolbar_width*id_stat/total_length)
-                        sys.stdout.write("-")
-                        sys.stdout.flush()
-            
+            store_eigenfunctions(Green_RW, current_struct, reoobj, periods_, offset, options)
             offset += len(periods_)
+                
+            ## Update progress bar
+            id_stat += len(periods_)
+            if(int(toolbar_width*id_stat/total_length) > cptbar):
+                    sys.stdout.write("-"*(int(toolbar_width*id_stat/total_length) - cptbar))
+                    sys.stdout.flush()
+                    cptbar = int(toolbar_width*id_stat/total_length)
             
         ## Deallocate
         del results
-        
         sys.stdout.write("] Done\n")
             
         return Green_RW
                 
+## Run earthsr in-process through the earthsr_ext extension (make earthsr_ext), with the model of generate_model_for_earthsr
+## Returns the dispersion table and the (model, blocks) of eigenfunctions, or None if earthsr_ext is not built
+## Raises RuntimeError where the earthsr program would stop
+def compute_dispersion_in_process(side, options):
+
+        try:
+                import earthsr_ext
+        except ImportError:
+                return None
+
+        h, model = earthsr_model(side, options)
+        model    = [model[key] for key in ['vp', 'vs', 'rho', 'Qa', 'Qb']]
+        cwarm    = warm_start_phase_velocities(options) if warm_start_enabled(options) else np.zeros((1, 1))
+
+        print(' model: in-process earthsr')
+        earthsr_ext.earthsr_compute(h, *model, options['earth_flattening'], options['ref_period'], options['type_wave'], 
+                                    options['min_max_phase'][0], options['min_max_phase'][1], options['nb_modes'][0], options['nb_modes'][1], 
+                                    options['nb_freq'], options['df'], options['freq_range'][0], 
+                                    np.atleast_1d(options['source_depth']).astype(float), options['receiver_depth'], cwarm, options['warm_start_tol'])
+        
+        ## Errors where the earthsr program stops are returned by earthsr_ext so that they do not end the python process
+        mem = earthsr_ext.earthsr_mem
+        if mem.ierr != 0:
+                problem = {1: 'problem with eigenfunction', 2: 'count problem in layer'}.get(int(mem.ierr), 'error %d' % (mem.ierr))
+                raise RuntimeError('earthsr: %s (mode %d, period %f s)' % (problem, mem.errnord, mem.errper))
+        
+        data_dispersion, model, blocks = reo.read_earthsr_mem(earthsr_ext.earthsr_mem)
+        
+        return data_dispersion, (model, blocks)
+
+## Layer thicknesses and properties of the model given to earthsr. The half space takes the thickness 0 and the properties 
+## of the layer above, as in input_code_earthsr
+def earthsr_model(side, options):
+
+        last  = options['nb_layers']-2
+        h     = np.append(np.array(options['h'][:last+1], dtype=float), 0.)
+        model = {key: np.append(np.array(side[key][:last+1], dtype=float), side[key][last]) for key in ['vp', 'vs', 'rho', 'Qa', 'Qb']}
+        
+        return h, model
+
+## Warm start of the root search of earthsr from the dispersion of a similar model, options['warm_start_dispersion'] being either
+## its dispersion table or the file where it was saved (PARAM_dispersion.npz). earthsr starts the search for the roots of each mode 
+## at the phase velocity of the similar model, within options['warm_start_tol'], where it has not found the two previous ones
+def warm_start_enabled(options):
+
+        return not isinstance(options['warm_start_dispersion'], str) or len(options['warm_start_dispersion']) > 0
+
+## Phase velocities of the similar model interpolated at the frequencies of the earthsr run set in options, one row per mode of 
+## options['nb_modes'] and one column per frequency in the order of earthsr (descending), 0 where the mode does not exist in the similar model
+def warm_start_phase_velocities(options):
+
+        reference = options['warm_start_dispersion']
+        if isinstance(reference, str):
+                reference = load_dispersion_table(reference)
+        
+        f     = options['freq_range'][0] + options['df']*np.arange(options['nb_freq']-1, -1, -1)
+        cwarm = np.zeros((options['nb_modes'][1] - options['nb_modes'][0] + 1, len(f)))
+        for imode, mode in enumerate(range(options['nb_modes'][0], min(options['nb_modes'][1]+1, len(reference)))):
+                valid = reference.valid[mode]
+                if not valid.any():
+                        continue
+                f_ref  = 1./reference.period[mode, valid]
+                order  = np.argsort(f_ref)
+                inside = (f >= f_ref.min()*(1.-1e-6)) & (f <= f_ref.max()*(1.+1e-6))
+                cwarm[imode, inside] = np.interp(f[inside], f_ref[order], reference.cphi[mode, valid][order])
+        
+        return cwarm
+
+## Indexes of the periods (ascending, as in get_eigenfunctions) of each of the options['earthsr_bands'] frequency bands
+def frequency_bands(options):
+
+        return np.array_split(np.arange(len(options['f_tab'])), options['earthsr_bands'])
+
+def band_folder(options, iband):
+
+        return options['global_folder'] + 'band_%d/' % (iband)
+
+## earthsr executable built next to this module (see Makefile), found independently of the current directory
+def earthsr_executable():
+
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'earthsr')
+
+## Start earthsr on the input file input_code_earthsr of each folder, writing its screen output to earthsr.log
+## Returns the running processes
+def start_earthsr_in_folders(folders):
+
+        earthsr   = earthsr_executable()
+        processes = []
+        for folder in folders:
+                with open(folder + 'earthsr.log', 'w') as log:
+                        processes.append( subprocess.Popen([earthsr, 'input_code_earthsr'], cwd=folder, stdout=log, stderr=subprocess.STDOUT) )
+        
+        return processes
+
+## Run earthsr concurrently on the input file input_code_earthsr of each folder
+def run_earthsr_in_folders(folders):
+
+        for process in start_earthsr_in_folders(folders):
+                process.wait()
+
+## Run one earthsr per frequency band concurrently, each in its own folder (see band_folder)
+## With options['band_depth_efolds'] > 0, the model of each band stops that many e-folding lengths of the eigenfunctions below
+## the depth where vs exceeds for good the phase velocity of the fastest mode of the band, and lies on the half space of the whole model.
+## Bands in which a mode has its cutoff keep the whole model
+## Returns the dispersion table of all bands, with the columns of disp_vconly
+def compute_dispersion_in_bands(side, options):
+
+        folders = write_band_inputs(side, options)
+        run_earthsr_in_folders(folders)
+        
+        return merge_band_dispersion(folders)
+
+## Write the earthsr input file of each frequency band, see compute_dispersion_in_bands. Returns the folders of all bands
+def write_band_inputs(side, options):
+
+        f_desc    = np.sort(options['f_tab'])[::-1]
+        bands     = frequency_bands(options)
+        folders   = [band_folder(options, iband) for iband in range(0, len(bands))]
+        layer_top = np.concatenate([[0.], np.cumsum(options['h'][:options['nb_layers']-1])])
+        vs        = np.array(side['vs'][:options['nb_layers']])
+        
+        options_bands = []
+        for ids in bands:
+                options_band = options.copy()
+                options_band['nb_freq']    = len(ids)
+                options_band['freq_range'] = [f_desc[ids[-1]], f_desc[ids[0]]]
+                options_bands.append( options_band )
+        
+        if options['band_depth_efolds'] > 0:
+        
+                ## The fastest mode of a band, the highest mode at the lowest frequency, is found with the whole model at the lowest and highest 
+                ## frequencies only. A mode with its cutoff inside the band is missing at the lowest frequency and reaches the half space 
+                ## around its cutoff, so that the whole model is kept for this band
+                probes = [folder + 'probe/' for folder in folders]
+                for probe, options_band in zip(probes, options_bands):
+                        options_probe = options_band.copy()
+                        options_probe['nb_freq'] = min(options_band['nb_freq'], 2)
+                        options_probe['df']      = options_band['freq_range'][1] - options_band['freq_range'][0]
+                        os.makedirs(probe, exist_ok=True)
+                        write_earthsr_input(probe + 'input_code_earthsr', side, options_probe)
+                run_earthsr_in_folders(probes)
+                
+                ## Source and receiver have to stay inside the model of each band so that layers are split at the same depths
+                nb_layers_min = np.searchsorted(layer_top, max(np.max(options['source_depth']), options['receiver_depth']), side='right') + 1
+                for probe, options_band in zip(probes, options_bands):
+                        data_probe = utils.load(probe + 'disp_vconly.input_code_earthsr').reshape(-1, 6)
+                        if data_probe.size == 0:
+                                continue
+                        lowest   = data_probe[:,1] == data_probe[:,1].max()
+                        if (~lowest).sum() > lowest.sum():
+                                continue
+                        cphi_max = data_probe[lowest,2].max()
+                        slower   = np.where(vs < cphi_max)[0]
+                        if slower.size == 0 or slower[-1] >= options['nb_layers']-2:
+                                continue
+                        
+                        ## Eigenfunctions decay as exp(-k*sqrt(1-c^2/vs^2)*z) below this depth, slowest for the lowest vs
+                        kn    = 2*np.pi*options_band['freq_range'][0]/cphi_max
+                        decay = kn*np.sqrt(1. - (cphi_max/vs[slower[-1]+1:].min())**2)
+                        zmax  = layer_top[slower[-1]+1] + options['band_depth_efolds'] / decay
+                        options_band['nb_layers'] = int(min(max(np.searchsorted(layer_top, zmax) + 1, nb_layers_min, 2), options['nb_layers']))
+        
+        for folder, options_band in zip(folders, options_bands):
+                os.makedirs(folder, exist_ok=True)
+                write_earthsr_input(folder + 'input_code_earthsr', side, options_band, options['nb_layers']-2)
+                print(' model: ' + folder + 'input_code_earthsr (%d layers)' % (options_band['nb_layers']))
+        
+        return folders
+
+## Dispersion tables of the bands computed in folders, merged into the order of a single run
+def merge_band_dispersion(folders):
+        
+        data_dispersion = []
+        for folder in folders:
+                data_band = utils.load(folder + 'disp_vconly.input_code_earthsr')
+                if data_band.size > 0:
+                        data_dispersion.append( data_band )
+        data_dispersion = np.concatenate(data_dispersion)
+        
+        ## Modes one after the other with ascending periods, as in the output of a single run
+        return data_dispersion[np.lexsort((data_dispersion[:,1], data_dispersion[:,0]))]
+
+## Pipelined version of compute_dispersion_in_bands followed by get_eigenfunctions: the eigenfunctions of each band are read
+## and added to the Green's tables as soon as its earthsr run ends, while the other bands are still being computed
+## Returns the dispersion table of all bands and the Green's tables
+def compute_green_in_bands(side, options):
+
+        folders   = write_band_inputs(side, options)
+        processes = start_earthsr_in_folders(folders)
+        
+        Green_RW = RW_atmos.RW_forcing(options)
+        periods  = 1./np.linspace(options['f_tab'][-1], options['f_tab'][0], len(options['f_tab']))
+        bands    = frequency_bands(options)
+        nb_modes = options['nb_modes'][1]
+        dtype    = np.float32 if options['eigen_float32'] else np.float64
+        
+        ## Dispersion characteristics of all periods, filled band after band
+        ## A mode exists at the shortest periods of a band, so its n-th period in band ids is period ids[0]+n
+        current_struct = dispersion_table(nb_modes, len(periods))
+        
+        pending = list(range(0, len(folders)))
+        while pending:
+                done = [iband for iband in pending if processes[iband].poll() is not None]
+                if not done:
+                        try:
+                                processes[pending[0]].wait(timeout=0.5)
+                        except subprocess.TimeoutExpired:
+                                pass
+                        continue
+                
+                for iband in done:
+                        pending.remove(iband)
+                        ids = bands[iband]
+                        
+                        data_band = utils.load(folders[iband] + 'disp_vconly.input_code_earthsr')
+                        if data_band.size == 0:
+                                continue
+                        fill_dispersion_table(current_struct, data_band, ids[0], len(ids))
+                        
+                        print(' band %d: storing eigenfunctions' % (iband))
+                        offset = ids[0]
+                        for reoobj, periods_ in read_eigenfunctions(folders[iband], periods[ids], 1, dtype, options):
+                                store_eigenfunctions(Green_RW, current_struct, reoobj, periods_, offset, options)
+                                offset += len(periods_)
+        
+        return merge_band_dispersion(folders), Green_RW
+
+## earthsr runs in its own temporary folder inside options['global_folder'], so that concurrent computations,
+## each with its own global folder, never share the working directory or output files
 def compute_dispersion_with_earthsr(no, side, options):
 
         ## Launch dispersion code
         print(' model: ' + side['name'])
-        os.system('./earthsr ' + 'input_code_earthsr')
+        with tempfile.TemporaryDirectory(prefix='earthsr_', dir=options['global_folder']) as sandbox:
+                sandbox = sandbox + '/'
+                shutil.copy(side['name'], sandbox + 'input_code_earthsr')
+                if warm_start_enabled(options):
+                        shutil.copy(options['global_folder'] + 'warm.input_code_earthsr', sandbox + 'warm.input_code_earthsr')
+                run_earthsr_in_folders([sandbox])
+                move_dispersion_files(no, sandbox, options)
 
-def move_dispersion_files(no, options):
+## Move the outputs of earthsr from its working folder to options['global_folder']
+def move_dispersion_files(no, folder, options):
 
-        os.system('mv ' + 'disp* ' + options['global_folder'])
-        os.system('mv ' + 'eigen* ' + options['global_folder'])
+        patterns = ['disp*', 'eigen*', 'derbin*', 'ray', 'earthsr.log'] # ray: binary output, see read_earth_io.read_binfile
         if(no > 0):
-                os.system('mv ' + 'tocomputeIO* ' + options['global_folder'])
+                patterns.append('tocomputeIO*')
+        for pattern in patterns:
+                for file in glob.glob(folder + pattern):
+                        shutil.move(file, options['global_folder'] + os.path.basename(file))
 
 ################################################################################################
-## Before finishing building coefficients, this routine saves dispersion characteristics to file
-def collect_dispersion_from_earthsr_and_save(nside, options):
+## Dispersion characteristics of all modes as (mode, period) arrays, periods ascending as in get_eigenfunctions
+## Entries where a mode does not exist are inf (0 for kn) and False in valid
+class dispersion_table():
 
-        data_dispersion_file_fund   = utils.load(options['global_folder'] + 'disp_vconly.input_code_earthsr')
+        keys = ['period', 'cphi', 'cg', 'QR', 'kn']
 
-        data_dispersion = [{} for i in range(0, options['nb_modes'][1])]
-        list_modes_side = [{} for j in range(0, options['nb_modes'][1])]
-        for nmode in range(0, options['nb_modes'][1]):
-            
-                list_modes_side[nmode]['loc']  = np.where(data_dispersion_file_fund[:,0] == nmode)
+        def __init__(self, nb_modes, nb_periods):
+        
+                for key in dispersion_table.keys:
+                        setattr(self, key, np.full((nb_modes, nb_periods), np.inf))
+                self.kn[:]  = 0.
+                self.valid  = np.zeros((nb_modes, nb_periods), dtype=bool)
+        
+        def __len__(self):
+        
+                return self.valid.shape[0]
+        
+        @property
+        def fks(self):
+        
+                return 1./self.period
+        
+        ## Wavenumbers (1/km) of the valid entries
+        def update_kn(self):
+        
+                self.kn = np.where(self.valid, 2.*np.pi/(self.period*self.cphi), 0.)
+        
+        ## Table restricted to the modes with at least one valid entry
+        def nonempty_modes(self):
+        
+                table = dispersion_table(0, self.valid.shape[1])
+                keep  = self.valid.any(axis=1)
+                for key in dispersion_table.keys + ['valid']:
+                        setattr(table, key, getattr(self, key)[keep])
+                
+                return table
+        
+        def save(self, file_name):
+        
+                np.savez(file_name, **{key: getattr(self, key) for key in dispersion_table.keys + ['valid']})
 
-                freq_domain = 0
-                if(list_modes_side[nmode]['loc'][0].size > 0):
-                        data_dispersion[nmode]['period'] = data_dispersion_file_fund[list_modes_side[nmode]['loc'][0],1]
-                        data_dispersion[nmode]['cphi']   = data_dispersion_file_fund[list_modes_side[nmode]['loc'][0],2]
-                        data_dispersion[nmode]['cg']     = data_dispersion_file_fund[list_modes_side[nmode]['loc'][0],3]
-                        data_dispersion[nmode]['QR']     = data_dispersion_file_fund[list_modes_side[nmode]['loc'][0],4]   
-
-                ## Add nan for periods where 1st mode has not been calculated
-                if(nmode > 0 and list_modes_side[nmode]['loc'][0].size > 0):
-
-                        cpt       = len(data_dispersion[nmode]['period'])-1
-                        save_cphi = data_dispersion[nmode]['cphi'][-1]*0. + np.inf
-                        save_cg   = data_dispersion[nmode]['cg'][-1]*0. + np.inf
-                        save_QR   = data_dispersion[nmode]['QR'][-1]*0. + np.inf
-                        while data_dispersion[nmode]['period'][-1] < data_dispersion[0]['period'][-1]:
-                                cpt += 1
-                                data_dispersion[nmode]['period'] = np.concatenate([data_dispersion[nmode]['period'], [data_dispersion[0]['period'][cpt]]])
-                                data_dispersion[nmode]['cphi']   = np.concatenate([data_dispersion[nmode]['cphi'], [save_cphi]])
-                                data_dispersion[nmode]['cg']     = np.concatenate([data_dispersion[nmode]['cg'], [save_cg]])
-                                data_dispersion[nmode]['QR']     = np.concatenate([data_dispersion[nmode]['QR'], [save_QR]])
+def load_dispersion_table(file_name):
+
+        data  = np.load(file_name)
+        table = dispersion_table(0, 0)
+        for key in dispersion_table.keys + ['valid']:
+                setattr(table, key, data[key])
+        
+        return table
+
+## Rows (nord, per, ...) of an earthsr dispersion table that go to table, with their mode and period number in table, the n-th period 
+## of a mode going to period number offset+n. Rows beyond nb_periods periods (by default the end of the table) are left out
+def dispersion_table_positions(table, data_dispersion, offset = 0, nb_periods = None):
+
+        nb_modes = len(table)
+        modes    = data_dispersion[:,0].astype(int)
+        keep     = np.where((modes >= 0) & (modes < nb_modes))[0]
+        order    = keep[np.lexsort((data_dispersion[keep,1], modes[keep]))]
+        modes    = modes[order]
+        nb_per_mode = np.bincount(modes, minlength=nb_modes)
+        position    = offset + np.arange(modes.size) - np.repeat(np.cumsum(nb_per_mode) - nb_per_mode, nb_per_mode)
+        inside      = position < (table.valid.shape[1] if nb_periods is None else offset + nb_periods)
+        
+        return order[inside], modes[inside], position[inside]
+
+## Fill table with the rows (nord, per, cc, u, q, ...) of an earthsr dispersion table, see dispersion_table_positions
+def fill_dispersion_table(table, data_dispersion, offset = 0, nb_periods = None):
+
+        rows, modes, position = dispersion_table_positions(table, data_dispersion, offset, nb_periods)
+        for icol, key in zip([1, 2, 3, 4], ['period', 'cphi', 'cg', 'QR']):
+                getattr(table, key)[modes, position] = data_dispersion[rows, icol]
+        table.valid[modes, position] = True
+        table.update_kn()
+
+################################################################################################
+## Before finishing building coefficients, this routine saves dispersion characteristics to file
+def collect_dispersion_from_earthsr_and_save(nside, options, data_dispersion_file_fund = None):
 
+        if data_dispersion_file_fund is None:
+                data_dispersion_file_fund   = utils.load(options['global_folder'] + 'disp_vconly.input_code_earthsr')
+
+        ## Scatter every (mode, period) row into mode x period tables in one pass
+        ## earthsr lists modes one after the other with ascending periods within each mode
+        nb_modes   = options['nb_modes'][1]
+        modes      = data_dispersion_file_fund[:,0].astype(int)
+        nb_periods = max(np.bincount(modes[(modes >= 0) & (modes < nb_modes)], minlength=1).max(), len(options['f_tab']), 1)
+        current_struct = dispersion_table(nb_modes, nb_periods)
+        fill_dispersion_table(current_struct, data_dispersion_file_fund)
+        
+        ## Periods where a mode does not exist are those of the fundamental mode
+        current_struct.period = np.where(current_struct.valid, current_struct.period, current_struct.period[:1])
+        
         ## Save with name "current_struct" to be consistent with resonance_eigen
-        current_struct = data_dispersion
-        for nmode in range(0, len(current_struct)):
-                if( len(current_struct[nmode]) > 0 ):
-                        current_struct[nmode]['fks'] = 1./current_struct[nmode]['period']
-            
-        utils.save_dict(current_struct, options['global_folder'] + 'PARAM_dispersion.mat')
+        current_struct.save(options['global_folder'] + 'PARAM_dispersion.npz')
         
         return current_struct
-               
+
+## Dispersion characteristics and Green's tables at the frequencies options['f_tab'], with earthsr run as set in options
+## Returns current_struct and Green_RW
+def compute_green(side, options):
+
+        ## Compute dispersion characteristics and eigenfunctions in-process if earthsr_ext is built
+        no = 0
+        Green_RW = []
+        data_dispersion, eigen_in_process = None, None
+        if options['earthsr_bands'] > 1 and options['earthsr_pipeline']:
+                data_dispersion, Green_RW = compute_green_in_bands(side, options)
+        elif options['earthsr_bands'] > 1:
+                data_dispersion = compute_dispersion_in_bands(side, options)
+        elif options['earthsr_in_process']:
+                earthsr_output = compute_dispersion_in_process(side, options)
+                if earthsr_output is not None:
+                        data_dispersion, eigen_in_process = earthsr_output
+        
+        if data_dispersion is None:
+        
+                ## Create file to use earthsr
+                generate_model_for_earthsr(side, options)
+                
+                ## Compute and store dispersion characteristics using earthsr
+                compute_dispersion_with_earthsr(no, side, options)
+
+        current_struct = collect_dispersion_from_earthsr_and_save(0, options, data_dispersion)
+        current_struct = current_struct.nonempty_modes()
+        options['nb_modes'] = [0, len(current_struct)] ## Update modes if necessary
+        
+        ## Class containing routine to construct RW/acoustic spectrum at a given location
+        if not Green_RW:
+                Green_RW = get_eigenfunctions(current_struct, options, eigen_in_process)
+        
+        return current_struct, Green_RW
+
+################################################################################################
+## Adaptive frequency sampling: earthsr only runs at options['nb_freq_adaptive'] uniform frequencies first, then at the midpoints
+## of the intervals where the Green's quantities of a mode depart from a linear variation by more than options['adaptive_freq_tol']
+## (relative to their largest value), until the spacing of options['f_tab'] is reached. Green's tables are then interpolated on options['f_tab']
+
+## Quantities of each mode kept at every computed frequency. Eigenfunctions are normalized to I1 = 1, which leaves
+## the Green's functions unchanged, so that they vary smoothly with frequency
+green_scalars      = ['cphi', 'cg', 'QR', 'r2']
+green_eigenvectors = ['r1_source', 'r2_source', 'dr1dz_source', 'dr2dz_source']
+
+def add_green_samples(samples, Green_RW):
+
+        table = Green_RW.table
+        for imode in range(0, len(table)):
+                if imode >= len(samples):
+                        samples.append( {key: [] for key in ['f'] + green_scalars + green_eigenvectors} )
+                iperiods = np.where(table.valid[imode])[0]
+                if len(iperiods) == 0:
+                        continue
+                norm = 1./np.sqrt(table.I1[imode, iperiods])
+                samples[imode]['f'].extend( 1./table.period[imode, iperiods] )
+                for key in ['cphi', 'cg', 'QR']:
+                        samples[imode][key].extend( getattr(table, key)[imode, iperiods] )
+                samples[imode]['r2'].extend( table.r2[imode, iperiods]*norm )
+                for key in green_eigenvectors:
+                        samples[imode][key].extend( getattr(table, key)[table.rows[imode, iperiods]]*norm.reshape(len(norm), 1) )
+                samples[imode]['dep']       = table.dep
+                samples[imode]['truncated'] = table.truncated
+
+## Samples of one mode as arrays of ascending frequencies. The sign of the eigenfunctions, arbitrary at each frequency,
+## is set so that they stay close to those of the previous frequency
+def green_sample_arrays(sample):
+
+        order  = np.argsort(sample['f'])
+        arrays = {key: np.array(sample[key])[order] for key in ['f'] + green_scalars + green_eigenvectors}
+        
+        overlap = np.sum(arrays['r1_source'][1:]*arrays['r1_source'][:-1] + arrays['r2_source'][1:]*arrays['r2_source'][:-1], axis=1)
+        sign    = np.concatenate([[1.], np.cumprod(np.where(overlap < 0., -1., 1.))])
+        arrays['r2'] *= sign
+        for key in green_eigenvectors:
+                arrays[key] *= sign.reshape(len(sign), 1)
+        
+        return arrays
+
+## New frequencies of f_tab (ascending) where earthsr has to run, grouped into uniformly spaced grids
+def refine_frequencies(samples, f_done, f_tab, options):
+
+        f_done  = np.sort(f_done)
+        flagged = np.zeros(max(len(f_done)-1, 0), dtype=bool)
+        for sample in samples:
+                if len(sample['f']) == 0:
+                        continue
+                arrays = green_sample_arrays(sample)
+                F      = arrays['f']
+                
+                ## The cutoff of a mode lies between its lowest frequency and the computed frequency below
+                ilow = np.searchsorted(f_done, F[0]) - 1
+                if ilow >= 0:
+                        flagged[ilow] = True
+                if len(F) < 3:
+                        continue
+                
+                ## Departure from the linear interpolation between the two neighbouring frequencies
+                idz    = [np.argmin(abs(sample['dep'] - depth)) for depth in np.atleast_1d(options['source_depth'])]
+                values = [arrays[key] for key in green_scalars] + [arrays[key][:,idz] for key in green_eigenvectors]
+                weight = ((F[1:-1] - F[:-2])/(F[2:] - F[:-2]))
+                error  = np.zeros(len(F)-2)
+                for value in values:
+                        value = value.reshape(len(F), -1)
+                        scale = max(abs(value).max(), 1e-30)
+                        pred  = value[:-2] + (value[2:] - value[:-2])*weight.reshape(len(weight), 1)
+                        error = np.maximum(error, abs(value[1:-1] - pred).max(axis=1)/scale)
+                
+                for k in np.where(error > options['adaptive_freq_tol'])[0]:
+                        flagged[np.searchsorted(f_done, F[k]):np.searchsorted(f_done, F[k+2])] = True
+        
+        ## Frequencies of f_tab closest to the midpoints of flagged intervals, so that cutoffs end up between two neighbouring 
+        ## frequencies of f_tab. Intervals without any frequency of f_tab inside are resolved
+        idone    = frequency_indexes(f_done, f_tab)
+        midpoint = f_tab[((idone[:-1] + idone[1:])//2)[flagged & (idone[1:] - idone[:-1] >= 2)]]
+        
+        return uniform_grids(midpoint)
+
+## Ascending frequencies f split into uniformly spaced grids, as taken by earthsr
+def uniform_grids(f):
+
+        grids = []
+        for f_ in np.sort(f):
+                if len(grids) > 0 and (len(grids[-1]) == 1 or np.isclose(f_ - grids[-1][-1], grids[-1][1] - grids[-1][0], rtol=1e-6)):
+                        grids[-1].append( f_ )
+                else:
+                        grids.append( [f_] )
+        
+        return [np.array(grid) for grid in grids]
+
+## Dispersion characteristics and Green's tables at the uniformly spaced frequencies grid, computed in folder
+def compute_green_on_grid(side, options, grid, folder):
+
+        options_grid = options.copy()
+        options_grid['f_tab']      = grid
+        options_grid['nb_freq']    = len(grid)
+        options_grid['df']         = abs(grid[1] - grid[0]) if len(grid) > 1 else 0.
+        options_grid['freq_range'] = [grid[0], grid[-1]]
+        options_grid['global_folder'] = folder
+        options_grid['earthsr_bands'] = 1
+        os.makedirs(folder, exist_ok=True)
+        
+        return compute_green(side, options_grid)
+
+## Green's tables and current_struct interpolated on options['f_tab'] from the samples of each mode
+def interpolate_green(samples, options):
+
+        import scipy.interpolate as spint
+
+        f_desc  = np.sort(options['f_tab'])[::-1]
+        df_min  = abs(f_desc[0] - f_desc[1]) if len(f_desc) > 1 else 0.
+        samples = [sample for sample in samples if len(sample['f']) > 0]
+        options['nb_modes'] = [0, len(samples)]
+        
+        ## No extrapolation: the mode only exists between its lowest and highest computed frequencies
+        insides = [np.where((f_desc >= min(sample['f']) - 1e-6*df_min) & (f_desc <= max(sample['f']) + 1e-6*df_min))[0] for sample in samples]
+        insides = [inside[:1] if len(sample['f']) == 1 else inside for sample, inside in zip(samples, insides)]
+        
+        Green_RW = RW_atmos.RW_forcing(options)
+        current_struct = dispersion_table(len(samples), len(f_desc))
+        current_struct.period[:] = 1./f_desc
+        table = Green_RW.table
+        for imode, (sample, inside) in enumerate(zip(samples, insides)):
+        
+                arrays = green_sample_arrays(sample)
+                F      = arrays['f']
+                if len(F) == 1:
+                        values = {key: arrays[key][:1].repeat(len(inside), axis=0) for key in green_scalars + green_eigenvectors}
+                else:
+                        values = {key: spint.PchipInterpolator(F, arrays[key], axis=0)(f_desc[inside]) for key in green_scalars + green_eigenvectors}
+                
+                if imode == 0:
+                        table.set_depths(sample['dep'], sample['truncated'], arrays['r1_source'].dtype)
+                        table.reserve(sum([len(inside_) for inside_ in insides]))
+                for key in green_scalars:
+                        getattr(table, key)[imode, inside] = values[key]
+                table.period[imode, inside] = 1./f_desc[inside]
+                table.kn[imode, inside] = 2.*np.pi*f_desc[inside]/values['cphi']
+                table.I1[imode, inside] = 1.
+                table.valid[imode, inside] = True
+                table.set_eigenvectors(np.full(len(inside), imode), inside, values)
+                
+                for key in ['cphi', 'cg', 'QR']:
+                        getattr(current_struct, key)[imode, inside] = values[key]
+                current_struct.valid[imode, inside] = True
+        
+        current_struct.update_kn()
+        
+        return current_struct, Green_RW
+
+def compute_green_adaptive(side, options):
+
+        ## Frequencies of f_tab with a uniform step giving at least nb_freq_adaptive frequencies, and the highest frequency
+        f_tab = np.sort(options['f_tab'])
+        step  = max(1, (len(f_tab)-1)//max(options['nb_freq_adaptive']-1, 1))
+        grids = uniform_grids(f_tab[np.unique(np.append(np.arange(0, len(f_tab), step), len(f_tab)-1))])
+        
+        samples, f_done = [], []
+        while grids:
+                for grid in grids:
+                        _, Green_grid = compute_green_on_grid(side, options, grid, options['global_folder'] + 'adaptive_%d/' % (len(f_done)))
+                        add_green_samples(samples, Green_grid)
+                        f_done += list(grid)
+                        del Green_grid
+                
+                grids = refine_frequencies(samples, f_done, f_tab, options)
+                print(' adaptive frequencies: %d computed, %d to add' % (len(f_done), sum([len(grid) for grid in grids])))
+        
+        current_struct, Green_RW = interpolate_green(samples, options)
+        current_struct.save(options['global_folder'] + 'PARAM_dispersion.npz')
+        
+        return current_struct, Green_RW
+
+################################################################################################
+## Incremental frequency extension: Green's tables computed at some frequencies are completed up to options['f_tab']
+## by solving only the missing frequencies. Nested frequency grids are obtained with options['coef_df'] > 0
+
+## Indexes in f_ref of the frequencies f, -1 for those that are not in f_ref
+def frequency_indexes(f, f_ref):
+
+        f_ref = np.asarray(f_ref)
+        order = np.argsort(f_ref)
+        pos   = np.clip(np.searchsorted(f_ref[order], f), 1, max(len(f_ref)-1, 1))
+        pos   = np.where(abs(f_ref[order][pos-1] - f) < abs(f_ref[order][pos] - f), pos-1, pos) if len(f_ref) > 1 else np.zeros(len(f), dtype=int)
+        found = np.isclose(f_ref[order][pos], f, rtol=1e-9, atol=0.)
+        
+        return np.where(found, order[pos], -1)
+
+## Dispersion table and Green's tables at the frequencies options['f_tab'], each frequency being taken from the first 
+## (current_struct, Green_RW) of parts computed at it
+def merge_green(parts, options):
+
+        f_desc   = np.sort(options['f_tab'])[::-1]
+        nb_modes = max([len(current_part) for current_part, _ in parts])
+        options['nb_modes'] = [0, nb_modes]
+        
+        Green_RW = RW_atmos.RW_forcing(options)
+        current_struct = dispersion_table(nb_modes, len(f_desc))
+        current_struct.period[:] = 1./f_desc
+        filled = np.zeros(len(f_desc), dtype=bool)
+        for current_part, Green_part in parts:
+                
+                ## Periods of each part are ascending, as those of options['f_tab']
+                index_part = frequency_indexes(f_desc, np.sort(Green_part.f_tab)[::-1])
+                iperiods   = np.where((index_part >= 0) & ~filled)[0]
+                Green_RW.table.set_periods(iperiods, Green_part.table, index_part[iperiods])
+                
+                nb_modes_part = len(current_part)
+                for key in dispersion_table.keys + ['valid']:
+                        getattr(current_struct, key)[:nb_modes_part, iperiods] = getattr(current_part, key)[:, index_part[iperiods]]
+                filled[iperiods] = True
+        
+        return current_struct, Green_RW
+
+## current_struct and Green_RW extended to the frequencies options['f_tab'], earthsr only running at the missing ones
+def extend_green(side, current_struct, Green_RW, options):
+
+        f_tab   = np.sort(options['f_tab'])
+        missing = f_tab[frequency_indexes(f_tab, Green_RW.f_tab) < 0]
+        print(' extension: %d frequencies of %d to compute' % (len(missing), len(f_tab)))
+        
+        parts = [(current_struct, Green_RW)]
+        for igrid, grid in enumerate(uniform_grids(missing)):
+                parts.append( compute_green_on_grid(side, options, grid, options['global_folder'] + 'extension_%d/' % (igrid)) )
+        
+        current_struct, Green_RW = merge_green(parts, options)
+        current_struct.save(options['global_folder'] + 'PARAM_dispersion.npz')
+        
+        return current_struct, Green_RW
+
+################################################################################################
+## Perturbation updates: a model close to the reference model stored in options['perturbation_reference'] takes the Green's tables
+## of the reference, with phase and group velocities updated to first order from the partial derivatives of phase velocity computed
+## by earthsr for the reference. earthsr only runs again when vp, vs or rho depart from the reference by more than options['perturbation_tol']
+
+## Model parameters of the partial derivatives written by earthsr, see reo.open_derbin
+def derivative_parameters(options):
+
+        return ['rho', 'vp', 'vs'] if options['type_wave'] == 1 else ['rho', 'vs']
+
+## Log derivatives of the phase velocity of each mode and period of current_struct w.r.t. the parameters of each layer of the model,
+## as a (mode, period, layer, parameter) array, read from the derbin file written by earthsr in options['global_folder']
+def read_dispersion_derivatives(current_struct, options):
+
+        dep, blocks = reo.open_derbin(options['global_folder'] + 'derbin.input_code_earthsr')
+        
+        ## Layers split by earthsr at the source and receiver depths are summed back into the layers of the model
+        h, _      = earthsr_model({key: np.zeros(options['nb_layers']) for key in ['vp', 'vs', 'rho', 'Qa', 'Qb']}, options)
+        layer_top = np.concatenate([[0.], np.cumsum(h[:-1])])
+        ilayer    = np.clip(np.searchsorted(layer_top, dep + 1e-9*max(layer_top[-1], 1.), side='right') - 1, 0, len(h)-1)
+        starts    = np.concatenate([[0], np.where(np.diff(ilayer) > 0)[0] + 1])
+        
+        nb_modes, nb_periods = current_struct.valid.shape
+        derivatives = np.zeros((nb_modes, nb_periods, len(h), blocks.dtype['der'].shape[1]), dtype=np.float32)
+        rows, modes, positions = dispersion_table_positions(current_struct, np.c_[blocks['mode'], blocks['period']])
+        for row, mode, position in zip(rows, modes, positions):
+                derivatives[mode, position, ilayer[starts]] = np.add.reduceat(blocks['der'][row], starts, axis=0)
+        
+        return derivatives
+
+## Dispersion characteristics and Green's tables of side computed with earthsr, stored with their partial derivatives as the 
+## reference of perturbation updates
+def compute_green_reference(side, options):
+
+        ## Partial derivatives are only written by the earthsr executable, over all frequencies at once
+        options_ref = options.copy()
+        options_ref['earthsr_derivatives'] = True
+        options_ref['earthsr_in_process']  = False
+        options_ref['earthsr_bands']       = 1
+        current_struct, Green_RW = compute_green(side, options_ref)
+        options['nb_modes'] = options_ref['nb_modes']
+        
+        h, model    = earthsr_model(side, options)
+        derivatives = read_dispersion_derivatives(current_struct, options_ref)
+        reference   = {'h': h, 'f_tab': np.asarray(options['f_tab']), 'type_wave': options['type_wave'], 'derivatives': derivatives, 
+                       'sensitive': abs(derivatives).max(axis=(0,1)) > 0., 'current_struct': current_struct, 'Green_RW': Green_RW}
+        for unknown in derivative_parameters(options):
+                reference[unknown] = model[unknown]
+        
+        ## Written to a temporary file first so that concurrent runs never read a partial reference
+        name_tmp = options['perturbation_reference'] + '.tmp' + str(os.getpid())
+        with open(name_tmp, 'wb') as f:
+                pickle.dump(reference, f)
+        os.replace(name_tmp, options['perturbation_reference'])
+        
+        return current_struct, Green_RW
+
+## Returns the reference stored in options['perturbation_reference'], or None if there is none
+def load_perturbation_reference(options):
+
+        try:
+                with open(options['perturbation_reference'], 'rb') as f:
+                        return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+                return None
+
+## Relative changes of the parameters of each layer of the reference, side being sampled at the middle of these layers
+## Returns a (layer, parameter) array, parameters ordered as the partial derivatives
+def model_perturbation(side, reference, options):
+
+        h, model  = earthsr_model(side, options)
+        layer_top = np.concatenate([[0.], np.cumsum(h[:-1])])
+        top_ref   = np.concatenate([[0.], np.cumsum(reference['h'][:-1])])
+        ilayer    = np.clip(np.searchsorted(layer_top, top_ref + 0.5*reference['h'], side='right') - 1, 0, len(h)-1)
+        
+        dlnm = np.zeros(reference['sensitive'].shape)
+        for ipar, unknown in enumerate(derivative_parameters(options)):
+                value_ref = reference[unknown]
+                dlnm[:,ipar] = np.where(value_ref != 0., model[unknown][ilayer]/np.where(value_ref != 0., value_ref, 1.) - 1., 0.)
+        
+        return dlnm
+
+## Dispersion and Green's tables of the reference with phase and group velocities updated for the relative changes dlnm of the 
+## parameters of its layers (see model_perturbation). Eigenfunctions, I1 and QR are those of the reference
+def perturb_green(reference, dlnm):
+
+        current_struct = reference['current_struct']
+        Green_RW       = reference['Green_RW']
+        derivatives    = reference['derivatives']
+        nb_modes, nb_periods = current_struct.valid.shape
+        
+        dlnc  = np.dot(derivatives.reshape(nb_modes*nb_periods, -1), dlnm.astype(np.float32).ravel()).reshape(nb_modes, nb_periods)
+        valid = current_struct.valid
+        cphi  = np.where(valid, current_struct.cphi*(1. + dlnc), current_struct.cphi)
+        
+        ## Group velocity from the change of wavenumber with frequency of each mode, 1/cg = dk/domega
+        omega = 2.*np.pi/current_struct.period
+        dkn   = np.where(valid, omega/cphi - omega/current_struct.cphi, 0.)
+        cg    = current_struct.cg.copy()
+        for imode in range(0, nb_modes):
+                iperiods = np.where(valid[imode])[0]
+                if len(iperiods) < 2:
+                        continue
+                cg[imode, iperiods] = 1./(1./cg[imode, iperiods] + np.gradient(dkn[imode, iperiods], omega[imode, iperiods]))
+        
+        ## Wavenumbers of the Green's tables are scaled rather than recomputed from the rounded periods of current_struct
+        ratio = np.where(valid, current_struct.cphi/np.where(valid, cphi, 1.), 1.)
+        current_struct.cphi = cphi
+        current_struct.cg   = cg
+        current_struct.update_kn()
+        
+        table    = Green_RW.table
+        nb_modes = min(len(table), nb_modes)
+        valid    = table.valid[:nb_modes]
+        table.cphi[:nb_modes] = np.where(valid, current_struct.cphi[:nb_modes], table.cphi[:nb_modes])
+        table.cg[:nb_modes]   = np.where(valid, current_struct.cg[:nb_modes], table.cg[:nb_modes])
+        table.kn[:nb_modes]  *= np.where(valid, ratio[:nb_modes], 1.)
+        
+        return current_struct, Green_RW
+
+## Dispersion characteristics and Green's tables of side from the reference when side is close enough to its model, computed with 
+## earthsr otherwise. The reference is computed from side when options['perturbation_reference'] does not exist yet
+def compute_green_perturbation(side, options):
+
+        reference = load_perturbation_reference(options)
+        if reference is None:
+                print(' perturbation: computing reference ' + options['perturbation_reference'])
+                return compute_green_reference(side, options)
+        
+        f_tab = np.asarray(options['f_tab'])
+        if reference['type_wave'] != options['type_wave'] or len(reference['f_tab']) != len(f_tab) or (frequency_indexes(f_tab, reference['f_tab']) < 0).any():
+                print(' perturbation: reference computed for other frequencies or waves, running earthsr')
+                return compute_green(side, options)
+        
+        dlnm   = model_perturbation(side, reference, options)
+        change = abs(dlnm[reference['sensitive']]).max() if reference['sensitive'].any() else 0.
+        if change > options['perturbation_tol']:
+                print(' perturbation: model change %.3f above tolerance, running earthsr' % (change))
+                if not warm_start_enabled(options):
+                        options['warm_start_dispersion'] = reference['current_struct']
+                return compute_green(side, options)
+        
+        print(' perturbation: model change %.3f, dispersion updated from the reference' % (change))
+        current_struct, Green_RW = perturb_green(reference, dlnm)
+        options['nb_modes'] = [0, len(current_struct)]
+        Green_RW.set_global_folder(options['global_folder'])
+        Green_RW.use_spawn    = options['USE_SPAWN_MPI']
+        Green_RW.google_colab = options['GOOGLE_COLAB']
+        current_struct.save(options['global_folder'] + 'PARAM_dispersion.npz')
+        
+        return current_struct, Green_RW
+
+################################################################################################
+## Cache of dispersion characteristics and Green's tables, shared between runs in options['coefs_cache_dir']
+## One entry per discretized model and set of options used by earthsr and get_eigenfunctions, named after the key of the model
+## and options and the key of the frequencies. The least recently used entries are removed when the cache grows above
+## options['coefs_cache_max_size'] (in GB)
+## Entries hold tables computed by earthsr at all frequencies only: interpolated tables of nb_freq_adaptive and tables updated
+## from perturbation_reference are neither read from nor written to the cache
+def coefs_cache_enabled(options):
+
+        return bool(options['coefs_cache_dir']) and not options['nb_freq_adaptive'] > 0 and not options['perturbation_reference']
+
+def coefs_cache_key(side, options):
+
+        key_f = hashlib.sha1(np.asarray(options['f_tab'], dtype=float).tobytes())
+
+        return coefs_cache_model_key(side, options) + '_' + key_f.hexdigest()
+
+def coefs_cache_model_key(side, options):
+
+        nb_layers = options['nb_layers']
+        key = hashlib.sha1()
+        key.update(np.asarray(options['h'][:nb_layers], dtype=float).tobytes())
+        for unknown in ['vp', 'vs', 'rho', 'Qa', 'Qb']:
+                key.update(np.asarray(side[unknown][:nb_layers], dtype=float).tobytes())
+        key.update(np.atleast_1d(np.asarray(options['source_depth'], dtype=float)).tobytes())
+        others = [options[name] for name in ['nb_modes', 'ATTENUATION', 'earth_flattening', 'ref_period', 'type_wave', 
+                                             'min_max_phase', 'receiver_depth', 'source_depth_band', 'eigen_float32', 'band_depth_efolds']]
+        key.update(repr(others).encode())
+
+        return key.hexdigest()
+
+## Returns (current_struct, Green_RW) stored under key, or None if there is no such entry
+def load_coefs_cache(key, options):
+
+        name = os.path.join(options['coefs_cache_dir'], key + '.pkl')
+        try:
+                with open(name, 'rb') as f:
+                        pickle.load(f) # Frequencies, already in the key
+                        current_struct, Green_RW = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+                return None
+        
+        ## Mark the entry as recently used
+        os.utime(name)
+        
+        return current_struct, Green_RW
+
+## Key of the entry of the same model and options whose frequencies are the largest subset of options['f_tab'], or None
+def find_coefs_cache_subset(side, options):
+
+        best, nb_best = None, 0
+        for name in glob.glob(os.path.join(options['coefs_cache_dir'], coefs_cache_model_key(side, options) + '_*.pkl')):
+                try:
+                        with open(name, 'rb') as f:
+                                f_tab = pickle.load(f)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                        continue
+                if len(f_tab) > nb_best and (frequency_indexes(f_tab, options['f_tab']) >= 0).all():
+                        best, nb_best = os.path.basename(name)[:-len('.pkl')], len(f_tab)
+        
+        return best
+
+## Stores current_struct and Green_RW under key, then removes the least recently used entries above the size limit
+## The entry is written to a temporary file first so that concurrent runs never read a partial entry
+def save_coefs_cache(key, current_struct, Green_RW, options):
+
+        os.makedirs(options['coefs_cache_dir'], exist_ok=True)
+        name     = os.path.join(options['coefs_cache_dir'], key + '.pkl')
+        name_tmp = name + '.tmp' + str(os.getpid())
+        with open(name_tmp, 'wb') as f:
+                pickle.dump(np.asarray(Green_RW.f_tab), f) # Read alone by find_coefs_cache_subset
+                pickle.dump((current_struct, Green_RW), f)
+        os.replace(name_tmp, name)
+        
+        entries = []
+        for entry in glob.glob(os.path.join(options['coefs_cache_dir'], '*.pkl')):
+                try:
+                        stat = os.stat(entry)
+                except OSError:
+                        continue
+                entries.append( (stat.st_mtime, stat.st_size, entry) )
+        entries.sort()
+        
+        size = sum([entry[1] for entry in entries])
+        for _, size_entry, entry in entries:
+                if size <= options['coefs_cache_max_size']*1e9 or entry == name:
+                        break
+                try:
+                        os.remove(entry)
+                except OSError:
+                        pass # Already removed by a concurrent run
+                size -= size_entry
+
 def compute_trans_coefficients(options_in = {}):        
         
         options = {} 
@@ -243,6 +1139,7 @@ def compute_trans_coefficients(options_in = {}):
         options['LOAD_2D_MODEL'] = False
         options['nb_layers']     = 1600#2800
         options['nb_freq']       = 128*4 # Number of frequencies
+        options['coef_df']       = 0. # Frequency step (Hz) replacing nb_freq, so that Green's tables in coefs_cache_dir can be extended to a higher coef_high_freq (0 => nb_freq frequencies)
         options['chosen_header'] = 'coefs_earthsr_sol_'
         options['PLOT']          = 1# 0 = No plot; 1 = plot after computing coef.; 2 = plot without computing coef.
         options['PLOT_folder']   = 'coefs_python_1.2_vs0.5_poisson0.25_h1.0_running_dir_1'
@@ -257,6 +1154,8 @@ def compute_trans_coefficients(options_in = {}):
         #options['models']['specfem'] = '/home/quentin/Documents/DATA/Ridgecrest/Ridgecrest_SSD/simulations/Ridgecrest_mesh_simu_fine_batch2_3/Ridgecrest_seismic.txt'
         options['chosen_model'] = 'specfem'
         options['zmax'] = 80000.
+        options['layer_wavelength_fraction'] = 0. # Layer thickness as a fraction of the shortest shear wavelength at each depth, keeping the model interfaces (0 => nb_layers uniform layers down to zmax)
+        options['layer_depth_wavelengths'] = 1. # With layer_wavelength_fraction > 0, the model stops at this number of longest wavelengths at the lowest frequency (at most zmax)
 
         ##############
         ## Auxiliaries
@@ -272,12 +1171,35 @@ def compute_trans_coefficients(options_in = {}):
         options['receiver_depth'] = 0 # (km)
         options['coef_low_freq']  = 0.001
         options['coef_high_freq'] = 0.5#1.
+        options['eigen_binary']   = False # Let earthsr write eigenfunctions in binary form instead of the ascii eigen file (requires earthsr built from this version)
+        options['eigen_float32']  = False # Store eigenfunctions in single precision (halves their memory, derived quantities stay in double precision)
+        options['source_depth_band'] = [] # [min, max] source depths (km) at which eigenfunctions are kept, I1 being computed beforehand ([] => all depths). Use to reduce the memory of Green's functions
+        options['coefs_cache_dir'] = '' # Folder where dispersion characteristics and Green's tables are kept between runs ('' => no cache)
+        options['coefs_cache_max_size'] = 10. # Size (GB) above which the least recently used entries of coefs_cache_dir are removed
+        options['eigen_cache_dir'] = '' # Folder where parsed eigenfunctions are kept between runs ('' => no cache). Entries hold all eigenfunctions and can reach several GB.
+        options['earthsr_bands']  = 1 # Number of frequency bands over which earthsr runs concurrently, each in its own folder (1 => one run over all frequencies)
+        options['band_depth_efolds'] = 0. # Model of each band stops this number of e-folding lengths of the eigenfunctions below the turning depth of its fastest mode (0 => whole model for all bands). 8 is safe: on Ridgecrest, Green's tables differ from the whole model by 1e-7 with 3 and 1e-13 with 8
+        options['nb_freq_adaptive'] = 0 # Number of uniform frequencies at which earthsr first runs before adaptive refinement, Green's tables being interpolated on the nb_freq frequencies (0 => earthsr at all nb_freq frequencies)
+        options['adaptive_freq_tol'] = 5e-2 # Largest relative departure of Green's quantities from a linear variation between computed frequencies
+        options['earthsr_pipeline'] = False # With earthsr_bands > 1, eigenfunctions of each band are read and stored as soon as its earthsr run ends, while the other bands are still computed
+        options['earthsr_in_process'] = True # Run earthsr through the earthsr_ext extension without any file when it is built (make earthsr_ext), the earthsr executable is used otherwise
+        options['earthsr_derivatives'] = False # Let earthsr write the partial derivatives of phase velocity w.r.t. the model in the binary derbin file (requires earthsr built from this version)
+        options['warm_start_dispersion'] = '' # Dispersion table of a similar model, or its file (PARAM_dispersion.npz of a previous run), from which earthsr starts the root search of each mode (requires earthsr built from this version, '' => search over the whole phase velocity range)
+        options['warm_start_tol'] = 5e-2 # Relative width of the first phase velocity steps of the root search around the phase velocities of warm_start_dispersion
+        options['perturbation_reference'] = '' # File of the reference model for perturbation updates, computed by the first run using it ('' => earthsr runs for every model)
+        options['perturbation_tol'] = 5e-2 # Largest relative change of vp, vs or rho from the reference model for which phase and group velocities are updated from its partial derivatives instead of running earthsr
         options['Loop']           = 0 # This this point the program loops over another set of input lines starting with the surface wave type (1st line after model).  If this is set to zero, the program will terminate.
         
         ## Update each option based on user input
         options.update( options_in )
         
-        f_tab = np.linspace(options['coef_low_freq'], options['coef_high_freq'], options['nb_freq'])
+        if options['coef_df'] > 0:
+                ## Frequencies with a fixed step, so that the frequencies of a lower coef_high_freq are a subset of these
+                nb_df = int(round( (options['coef_high_freq'] - options['coef_low_freq'])/options['coef_df'] ))
+                f_tab = options['coef_low_freq'] + options['coef_df']*np.arange(0, nb_df+1)
+                options['nb_freq'] = len(f_tab)
+        else:
+                f_tab = np.linspace(options['coef_low_freq'], options['coef_high_freq'], options['nb_freq'])
         options['f_tab']   = f_tab
         #options['nb_freq'] = len(f_tab)
         options['df']      = abs( f_tab[1] - f_tab[0] )
@@ -305,25 +1227,45 @@ def compute_trans_coefficients(options_in = {}):
                 ## TODO: Creation side vs models
                 side = velocity_models.create_velocity_model(options)
                 
-                ## Create file to use earthsr
-                generate_model_for_earthsr(side, options)
-                
-                ## Compute and store dispersion characteristics using earthsr
-                no = 0
-                compute_dispersion_with_earthsr(no, side, options)
-                
-                ## Compute purely1d coefficients
-                move_dispersion_files(no, options)
+                ## Dispersion characteristics and Green's tables already computed for this model
+                if coefs_cache_enabled(options):
+                        key    = coefs_cache_key(side, options)
+                        cached = load_coefs_cache(key, options)
+                        
+                        ## Entry computed at part of the frequencies: only the missing ones are solved
+                        subset = None
+                        if cached is None:
+                                key_subset = find_coefs_cache_subset(side, options)
+                                subset     = load_coefs_cache(key_subset, options) if key_subset is not None else None
+                        if subset is not None:
+                                cached = extend_green(side, *subset, options)
+                                save_coefs_cache(key, *cached, options)
+                        
+                        if cached is not None:
+                                print(' model: from cache ' + key)
+                                current_struct, Green_RW = cached
+                                options['nb_modes'] = [0, len(current_struct)]
+                                Green_RW.set_global_folder(options['global_folder'])
+                                Green_RW.use_spawn    = options['USE_SPAWN_MPI']
+                                Green_RW.google_colab = options['GOOGLE_COLAB']
+                                current_struct.save(options['global_folder'] + 'PARAM_dispersion.npz')
+                                velocity_models.create_velocity_figures(current_struct, options)
+                                return Green_RW, options
                 
-                current_struct = collect_dispersion_from_earthsr_and_save(0, options)
-                current_struct = [key for key in current_struct if key]
-                options['nb_modes'] = [0, len(current_struct)] ## Update modes if necessary
+                ## Compute dispersion characteristics and Green's tables, with earthsr at all frequencies or at adaptively chosen ones,
+                ## or from the partial derivatives of a reference model
+                if options['nb_freq_adaptive'] > 0:
+                        current_struct, Green_RW = compute_green_adaptive(side, options)
+                elif options['perturbation_reference']:
+                        current_struct, Green_RW = compute_green_perturbation(side, options)
+                else:
+                        current_struct, Green_RW = compute_green(side, options)
                 
                 ## Create velocity figures
                 velocity_models.create_velocity_figures(current_struct, options)
                 
-                ## Class containing routine to construct RW/acoustic spectrum at a given location
-                Green_RW = get_eigenfunctions(current_struct, options)
+                if coefs_cache_enabled(options):
+                        save_coefs_cache(key, current_struct, Green_RW, options)
                 
                 ## Compute sensitivity maps
                 if(False):
@@ -4,6 +4,14 @@ c    n0,iefl,tref   # layers in model(including half space) and earth
 c                  flattening control variable ( > 0 applies correction),
 c                  reference period for material dispersion correction
 c                  (0 for none)
+c                  An optional 4th value ibin = 1 writes the eigenfunctions
+c                  to the binary file eigenbin.<input file> instead of the
+c                  ascii eigen. and tocomputeIO. files (0 or absent: ascii)
+c                  (ibin = 2 is set by earthsr_py.f, which keeps them in memory)
+c                  An optional 5th value ider = 1 writes the partial derivatives
+c                  of phase velocity to the binary file derbin.<input file>
+c                  An optional 6th value iwarm = 1 reads trial phase velocities
+c                  of each branch and frequency from warm.<input file>, see warm
 c    d,vp,vs,rho,qbeta,qalpha   model,d is layer thickness. model can
 c                  include a one layer ocean (signalled by setting vs = 0
 c                  in the top layer). half space can have any thickness
@@ -28,6 +36,7 @@ c
 	include 'units.inc'
 
 	common/m/d(lyrs),ro(lyrs),vp(lyrs),vs(lyrs),fu(lyrs),n,noc,ist,iasc
+	common/bin/ibin,ider
 	common/m0/d0(lyrs),ro0(lyrs),vp0(lyrs),vs0(lyrs),
      &           qb0(lyrs),qa0(lyrs),n0
 	common/mq/vps(lyrs),vss(lyrs)
@@ -35,7 +44,8 @@ c
 	common/bran/ce(2),ke(2),de(2),ctry,ceps,um,cm,cmx,cmn
 	common/bits/u,nsrce,idep(lsd),nord,tpi,sdep(lsd),ig,idisc,irdep
 
-	character*(256) infil
+	character*(256) infil, hdline
+	real*8, allocatable :: cwarm(:,:)
 
 c -- Arjun: excitations--
         real depth(lyrs)
@@ -80,10 +90,6 @@ cccc -- Arjun: ascii files to be written only if iasc=1
 	  open(iouf2,file = outfil,status='replace')
 	  outfil = 'disp_vconly.'//trim(infil)
 	  open(iouf3,file = outfil,status='replace')
-	  outfil = 'tocomputeIO.'//trim(infil) 
-          open(150,file=outfil,status='replace')
-          outfil = 'eigen.'//trim(infil) 
-          open(10,file=outfil,status='replace')
 c	  outfil_exasc = 'excitation.'//trim(infil) 
 c         open(11,file=outfil_exasc,status='replace')
 c -- iouf2 is the stream to the ascii dispersion file
@@ -92,7 +98,56 @@ c -- 10  is the stream to the eigenfunction file
 c -- 11 is the stream to the ascii excitaion file
 	endif
 cccc -- Arjun: ascii files
-	read(iinf1,*,end = 777) n0,iefl,tref
+c -- the optional 4th value of the first line selects binary eigenfunctions,
+c -- the optional 5th value the binary partial derivatives and the optional
+c -- 6th value the trial phase velocities. The slash ending the line leaves
+c -- the values that are not given unchanged
+	ibin = 0
+	ider = 0
+	iwarm = 0
+	read(iinf1,'(a256)',end = 777) hdline
+	hdline(256:256) = '/'
+	read(hdline,*) n0,iefl,tref,ibin,ider,iwarm
+	if (ibin.ne.1) ibin = 0
+	if (ider.ne.1) ider = 0
+	if (iwarm.ne.1) iwarm = 0
+c -- iinf2 is the stream to the trial phase velocities: nwm,nwf,wtol then
+c -- nwf values for each of nwm branches from nbran1, see warm
+	if(iwarm.eq.1) then
+	  outfil = 'warm.'//trim(infil)
+	  open(iinf2,file = outfil,status='old')
+	  read(iinf2,*) nwm,nwf,wtol
+	  allocate(cwarm(nwm,nwf))
+	  read(iinf2,*) ((cwarm(k,i),i=1,nwf),k=1,nwm)
+	  close(iinf2)
+	endif
+c -- 10 and 150 are the streams to the ascii eigenfunction files
+        if(iasc.eq.1 .and. ibin.eq.0) then
+	  outfil = 'tocomputeIO.'//trim(infil) 
+          open(150,file=outfil,status='replace')
+          outfil = 'eigen.'//trim(infil) 
+          open(10,file=outfil,status='replace')
+	endif
+c -- iouf4 is the stream to the binary eigenfunction file: little-endian
+c -- stream without record markers. Header: n, ncol (4 rayleigh, 2 love)
+c -- then n rows of depth,vs,rho,vp. Then one block per mode and period:
+c -- nord,ls,per,cc,u,norm followed by ncol values for each of the n
+c -- layers (values below layer ls repeat those of layer ls)
+	if(ibin.eq.1) then
+	  outfil = 'eigenbin.'//trim(infil)
+	  open(iouf4,file = outfil,status='replace',access='stream',
+     &         form='unformatted',convert='little_endian')
+	endif
+c -- iouf5 is the stream to the binary partial derivatives file, as iouf4.
+c -- Header: n, npar (3 rayleigh: rho, vp, vs; 2 love: rho, vs) then n rows
+c -- of depth,vs,rho,vp. Then one block per mode and period: nord,ls,per,cc,u
+c -- followed by the npar log. derivatives of phase velocity for each of the
+c -- n layers (0 below layer ls)
+	if(ider.eq.1) then
+	  outfil = 'derbin.'//trim(infil)
+	  open(iouf5,file = outfil,status='replace',access='stream',
+     &         form='unformatted',convert='little_endian')
+	endif
 	omref = 0.d0
 	if (tref.ne.0.d0) omref = tpi/tref
 
@@ -152,6 +207,7 @@ ccc -- Arjun: ascii files ------------------------------------------------------
 	  write(iouf2,'(1X,f7.3,3(1x,f10.6))') d(i),ro(i),vps(i),vss(i)
 	enddo
 
+	 if(ibin.eq.0) then
 	  write(10,'(a)') 'eigenfunction file from earthsr'
 	  write(10,'(i4,1x,a)') n, ' layers in model'
           depth(1) = 0
@@ -161,8 +217,27 @@ c -- output depths instead of thicknesses
             !write(10,'(4(1x,f8.3))') depth(i), vss(i), ro(i), vps(i)
             write(10,'(5e15.7,5e15.7,5e15.7,5e15.7)') depth(i), vss(i), ro(i), vps(i)
 	  enddo
+	 endif
 	endif
 ccc -- Arjun: ascii files --------------------------------------------------------
+	if(ibin.eq.1) then
+	  ncol = 6 - 2*jcom
+	  write(iouf4) n, ncol
+	  dpt = 0.d0
+	  do i = 1,n
+	    write(iouf4) dpt, vss(i), ro(i), vps(i)
+	    dpt = dpt + d(i)
+	  enddo
+	endif
+	if(ider.eq.1) then
+	  npar = 4 - jcom
+	  write(iouf5) n, npar
+	  dpt = 0.d0
+	  do i = 1,n
+	    write(iouf5) dpt, vss(i), ro(i), vps(i)
+	    dpt = dpt + d(i)
+	  enddo
+	endif
 
 	call flat(jcom,iefl)
       if(iasc.eq.1) then
@@ -217,7 +292,7 @@ c	omax = (nh + 1)*dom
 c -- Arjun: ascii files --
 	if(iasc.eq.1) then
 	  write(iouf2,'(i3,1x,a)') nbran, 'modes listed in file'
-          write(10,'(i3,7x,a)') nbran, 'modes listed in file'
+          if(ibin.eq.0) write(10,'(i3,7x,a)') nbran, 'modes listed in file'
 c      write(10,*) "Number of periods included : ",nperiods
 	endif
 c -- Arjun: ascii files --
@@ -235,7 +310,7 @@ c  Start with the lower mode, come back here for the next higher mode when this
 	write(iouf1) nb
 c	write(11,'(2X,I2)') nb
 c -- Arjun: eigenfunctions
-      if(iasc.eq.1) then
+      if(iasc.eq.1 .and. ibin.eq.0) then
         write(10,'(I3,7X,A)') nb, "mode number"
         per_mall = 0
 	per_mint = 0
@@ -249,6 +324,7 @@ c  So this loop is only to determine how many periods per mode will be there in
 	  ctst = c2
 	  if (ctst.le.0.d0) ctst = cmax
 	  cmx = dmin1(ctst,cmax)
+	  if (iwarm.eq.1) call warm(cwarm,nwm,nwf,wtol,nb-nbran1+1,i)
 	  call cex(om,nb,jcom,nev)
           period = tpi/om
 
@@ -284,6 +360,7 @@ c --  End Arjun: eigenfunctions
 	  ctst = c2
 	  if (ctst.le.0.d0) ctst = cmax
 	  cmx = dmin1(ctst,cmax)
+	  if (iwarm.eq.1) call warm(cwarm,nwm,nwf,wtol,nb-nbran1+1,i)
 	  call cex(omuse,nb,jcom,nev)
 c	  write(*,*), "Period is: ", tpi/omuse, "nev is: ", nev
 	  if (nev.eq.0)go to 40
@@ -306,6 +383,7 @@ c       write(11,'(2X,I2)') istop
 	go to 45
 
 777	close(iinf1)
+	if (allocated(cwarm)) deallocate(cwarm)
         if (nusrper.gt.0) then
           deallocate(usrper)
           deallocate(usrom)
@@ -314,10 +392,12 @@ c       write(11,'(2X,I2)') istop
         write(*,'(a,a)') ' output s_d vector file is : ', outfil
 	 close(iouf2)
 	 close(iouf3)
-	 close(10)
-	 close(150)
+	 if(ibin.eq.0) close(10)
+	 if(ibin.eq.0) close(150)
 c	 close(11)
         endif
+	if(ibin.eq.1) close(iouf4)
+	if(ider.eq.1) close(iouf5)
 	stop
 	end
 
@@ -447,6 +527,7 @@ c  cf mendiguren j.g.r. 1977 for excitation functions
 	common/q/qb(lyrs),qa(lyrs)
 	common/bits/u,nsrce,idep(lsd),nord,tpi,sdep(lsd),ig,idisc,irdep
 	common/m/d(lyrs),ro(lyrs),vp2(lyrs),vs2(lyrs),fu(lyrs),n,noc,ist,iasc
+	common/bin/ibin,ider
 c -- new variable added by Arjun
 	dimension dep(lyrs)
         integer, save :: iprev = 1
@@ -538,8 +619,15 @@ c     were written out in their place
 	enddo
       enddo
        per = tpi/w
+c -- binary eigenfunctions on all n layers --
+      if(ibin.eq.1) then
+        write(iouf4) nord,ls,per,cc,u,(w*w/(cc*si3)),
+     &               ((x(ir,min(ic,ls)),ir=1,4),ic=1,n)
+      endif
+c -- in-memory eigenfunctions, see earthsr_py.f --
+      if(ibin.eq.2) call store_egn(nord,ls,per,cc,u,(w*w/(cc*si3)),x,4)
 c -- Arjun: output eigenfunctions --
-      if(iasc.eq.1) then
+      if(iasc.eq.1 .and. ibin.eq.0) then
 	if (abs(per-nint(per)).lt.0.00001) then
 	  intper=1
         else
@@ -574,7 +662,7 @@ c    ignore attenuation in the ocean
      1           +  x(3,irdep)/(ro(irdep)*vp2(irdep)) )
 c *** Now output all the quantities for equations 13a and 13b in G&M ***
 c *** x(1,irdep) and x(2,irdep) are the same as b1(zr) and b2(zr) in eqns 13a and 13b in G&M ***
-	write(iouf1) w,cc,gam,x(1,irdep),x(2,irdep),gb1,gb2
+	if(ibin.ne.2) write(iouf1) w,cc,gam,x(1,irdep),x(2,irdep),gb1,gb2
 c       write(*,*) "From deriv: ls is ", ls , "& irdep is ", irdep
 c	write(11,'(7(2X,F10.6))') w,cc,gam,x(1,irdep),x(2,irdep),gb1,gb2
 c -- Arjun: Description of what goes into the (binary) excitations file-
@@ -601,11 +689,20 @@ c *** py3 is the second term of eqn 13a in G&M ***
 	    py2 = 0.d0
 	    py3 = 0.d0
 	  endif
-	  write(iouf1) py1,py2,py3
+	  if(ibin.ne.2) write(iouf1) py1,py2,py3
 c	  write(11,'(3(2X,F7.4))') py1,py2,py3
 	enddo
 
 	if (q.ne.0.d0)q = 1.d0/q
+	if(ibin.eq.2) call store_disp(nord,per,cc,u,q,flan)
+	if(ider.eq.1) then
+	  do i = ls+1,n
+	    do j = 1,3
+	      der(j,i) = 0.d0
+	    enddo
+	  enddo
+	  write(iouf5) nord,ls,per,cc,u,((der(j,i),j=1,3),i=1,n)
+	endif
 c ------- Arjun: output to ascii dispersion file --------------------------------
       if(iasc.eq.1) then
 c -- Modif. ARJUN - phase velocity partial derivatives now output to the ascii
@@ -641,6 +738,10 @@ c -- End Arjun: output to the ascii dispersion file ----------------------------
 999	write(*,950) flan
 950	format(' problem with eigenfunction : flan  = ',g15.7)
 
+	if (ibin.eq.2) then
+	  call store_err(1,nord,tpi/w)
+	  return
+	endif
 	stop
 	end
 
@@ -654,6 +755,7 @@ c  is returned. if ifeif = 1 derivatives,excitations etc. are computed
 
 	common/x/x(2,lyrs),scale(lyrs),der(2,lyrs),dummy(lyrs*2)
 	common/m/d(lyrs),ro(lyrs),vp2(lyrs),vs2(lyrs),fu(lyrs),n,noc,ist,iasc
+	common/bin/ibin,ider
 	common/bits/u,nsrce,idep(lsd),nord,tpi,sdep(lsd),ig,idisc,irdep
 	common/q/qb(lyrs),qa(lyrs)
 
@@ -729,8 +831,15 @@ c  der(1,i),der(2,i)are the log. derivatives of phase velocity wrt rho and vs
 	if (i.gt.noc) go to 35
 	u = p*si3/si1
        per = tpi/w
+c -- binary eigenfunctions on all n layers --
+      if(ibin.eq.1) then
+        write(iouf4) nord,ls,per,cc,u,(si3*cc/w*w),
+     &               ((x(ir,min(ic,ls)),ir=1,2),ic=1,n)
+      endif
+c -- in-memory eigenfunctions, see earthsr_py.f --
+      if(ibin.eq.2) call store_egn(nord,ls,per,cc,u,(si3*cc/w*w),x,2)
 c -- Arjun: output eigenfunctions --
-      if(iasc.eq.1) then
+      if(iasc.eq.1 .and. ibin.eq.0) then
 	if (abs(per-nint(per)).lt.0.00001) then
 	  intper=1
         else
@@ -769,7 +878,7 @@ c  compute 'excitation' functions.py1,py2 correspond to a,b in mendiguren
 	  x(2,irdep)=0.0
         endif
 	gb1 = w*x(2,irdep)/fu(irdep)      
-	write(iouf1) w,cc,gam,x(1,irdep),gb1
+	if(ibin.ne.2) write(iouf1) w,cc,gam,x(1,irdep),gb1
 c	write(*,*) "From detlov: ls is ", ls , "& irdep is ", irdep
 c	write(11,'(5(2X,F10.6))') w,cc,gam,x(1,irdep),gb1
 	fact = 1.d0/(dsqrt(p*w)*si3*15.853309d-6)
@@ -780,10 +889,20 @@ c	write(11,'(5(2X,F10.6))') w,cc,gam,x(1,irdep),gb1
 	if (id.le.ls) go to 45
 	py1 = 0.d0
 	py2 = 0.d0
-45	write(iouf1) py1,py2
+45	if(ibin.ne.2) write(iouf1) py1,py2
 c	write(11,'(2(2X,F7.4))') py1,py2
 	per = tpi/w
 	if (q.ne.0.d0)q = 1.d0/q
+	if(ibin.eq.2) call store_disp(nord,per,cc,u,q,flan)
+	if(ider.eq.1) then
+	  do i = 1,n
+	    if (i.lt.noc .or. i.gt.ls) then
+	      der(1,i) = 0.d0
+	      der(2,i) = 0.d0
+	    endif
+	  enddo
+	  write(iouf5) nord,ls,per,cc,u,((der(j,i),j=1,2),i=1,n)
+	endif
 c ------ Arjun: output to ascii dispersion file -------------------------------
         if(iasc.eq.1) then
 	 write(iouf2,900) nord,per,cc,u,q,flan,0,0
@@ -796,9 +915,34 @@ c ------ End Arjun: outout to ascii dispersion file -------------------------
 999	write(*,950) flan
 950	format(' problem with eigenfunction : flan  = ',g15.7)
 
+	if (ibin.eq.2) then
+	  call store_err(1,nord,tpi/w)
+	  return
+	endif
 	stop
 	end
 
+	subroutine warm(cwarm,nwm,nwf,wtol,kw,i)
+c  sets the trial phase velocity ctry +- ceps of cex for branch number kw
+c  (from nbran1) at the i-th frequency (descending, as in the main loop) to
+c  cwarm(kw,i), the phase velocity of a similar model, within a relative
+c  tolerance wtol. The trial values of earthsr are kept where cwarm is 0 (the
+c  branch of the similar model does not exist) and where intrp extrapolated
+c  them from the two previous roots of the branch, which is more accurate
+	implicit real*8 (a-h, o-z)
+
+	dimension cwarm(nwm,nwf)
+	common/bran/ce(2),ke(2),de(2),ctry,ceps,um,cm,cmx,cmn
+
+	if (cm.gt.0.d0 .and. ctry.gt.0.d0) return
+	if (kw.lt.1 .or. kw.gt.nwm .or. i.gt.nwf) return
+	if (cwarm(kw,i).le.0.d0) return
+	ctry = cwarm(kw,i)
+	ceps = wtol*ctry
+
+	return
+	end
+
 	subroutine intrp(om,dom,jcom)
 c  interpolates between bracketing c's to find the root.uses a bisection scheme.
 	implicit real*8(a - h,o - z)
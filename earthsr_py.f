@@ -0,0 +1,245 @@
+c*** in-memory version of the earthsr program ***
+c  earthsr_compute does the computation of the earthsr program (see earthsr.f) for one
+c  wave type, taking the model and the options as arguments instead of the input file.
+c  No file is written: dispersion and eigenfunctions are kept in module earthsr_mem.
+c  It is built with earthsr.f and earthsubs.f as the python extension earthsr_ext
+c  (make earthsr_ext), see RW_dispersion.compute_dispersion_in_process
+c
+c  earthsr_mem holds, after a call to earthsr_compute :
+c    ndisp,disp(6,ndisp)   nord,per,cc,u,q,flan of each mode and period (disp_vconly.)
+c    nlay,egnmod(4,nlay)   depth,vs,rho,vp of the layers (header of eigenbin.)
+c    negn,egnhead(6,negn)  nord,ls,per,cc,u,norm of each mode and period
+c    egny(ncol,nlay,negn)  eigenfunctions (4 rayleigh, 2 love) on all layers, values
+c                          below layer ls repeat those of layer ls (blocks of eigenbin.)
+c    ierr,errnord,errper   0 if earthsr went through, otherwise the error where the
+c                          earthsr program stops (1 problem with eigenfunction, 2 count
+c                          problem in layer) with the mode (-1 if unknown) and period,
+c                          see store_err. No mode is searched after an error
+
+	module earthsr_mem
+
+	implicit none
+
+	integer ndisp,negn,nlay,ncol,errnord
+	integer :: ierr = 0
+	real*8 errper
+	real*8, allocatable :: disp(:,:),egnmod(:,:),egnhead(:,:)
+	real*8, allocatable :: egny(:,:,:)
+
+	end module earthsr_mem
+
+	subroutine earthsr_compute(n0in,din,vpin,vsin,roin,qbin,qain,
+     &           iefl,tref,jcomin,c1,c2,nbran1,nbran2,
+     &           nsrcein,nom,df,fo,sdepin,rdep,nwm,nwf,cwarm,wtol)
+c  same inputs as the lines of the earthsr input file, qbin and qain being
+c  the 5th and 6th columns of the model, and cwarm and wtol the trial phase
+c  velocities of warm.<input file> (all 0 for none, see warm in earthsr.f)
+	use earthsr_mem
+
+	implicit real*8 (a-h, o-z)
+
+	include 'sizes.inc'
+
+	integer n0in,iefl,jcomin,nbran1,nbran2,nsrcein,nom,nwm,nwf
+	real*8 din(n0in),vpin(n0in),vsin(n0in),roin(n0in)
+	real*8 qbin(n0in),qain(n0in),sdepin(nsrcein),cwarm(nwm,nwf)
+
+	common/m/d(lyrs),ro(lyrs),vp(lyrs),vs(lyrs),fu(lyrs),n,noc,ist,iasc
+	common/bin/ibin,ider
+	common/m0/d0(lyrs),ro0(lyrs),vp0(lyrs),vs0(lyrs),
+     &           qb0(lyrs),qa0(lyrs),n0
+	common/mq/vps(lyrs),vss(lyrs)
+	common/q/qb(lyrs),qa(lyrs)
+	common/bran/ce(2),ke(2),de(2),ctry,ceps,um,cm,cmx,cmn
+	common/bits/u,nsrce,idep(lsd),nord,tpi,sdep(lsd),ig,idisc,irdep
+
+	real*4 usrom
+
+c -- no ascii file, eigenfunctions and dispersion go to earthsr_mem
+	iasc = 0
+	ibin = 2
+	ider = 0
+	tpi  = 6.2831853071796d0
+c -- period at which a solution is ensured, as in earthsr
+	usrom = tpi/10000.
+	ndisp = 0
+	negn  = 0
+	ierr  = 0
+	errnord = -1
+	errper  = 0.d0
+
+	n0 = n0in
+	omref = 0.d0
+	if (tref.ne.0.d0) omref = tpi/tref
+	do i = 1,n0
+	  d0(i)  = din(i)
+	  vp0(i) = vpin(i)
+	  vs0(i) = vsin(i)
+	  ro0(i) = roin(i)
+	  qb0(i) = qbin(i)
+	  qa0(i) = qain(i)
+	  if (qb0(i).ne.0.d0) qb0(i) = 1.d0/qb0(i)
+	  if (qa0(i).ne.0.d0) qa0(i) = 1.d0/qa0(i)
+	enddo
+	jcom = jcomin
+	if (jcom.eq.0) return
+	if (jcom.ne.1) jcom = 2
+
+	n = n0
+	do i = 1,n
+	  d(i)   = d0(i)
+	  ro(i)  = ro0(i)
+	  vps(i) = vp0(i)
+	  vss(i) = vs0(i)
+	  qa(i)  = qa0(i)
+	  qb(i)  = qb0(i)
+	enddo
+	nsrce = nsrcein
+	do i = 1,nsrce
+	  sdep(i) = sdepin(i)
+	enddo
+	call shell(sdep,nsrce)
+
+	call rsplit(rdep)
+	call split(rdep)
+
+	ncol = 6 - 2*jcom
+	nlay = n
+	if (allocated(egnmod)) deallocate(egnmod)
+	allocate(egnmod(4,nlay))
+	dpt = 0.d0
+	do i = 1,n
+	  egnmod(1,i) = dpt
+	  egnmod(2,i) = vss(i)
+	  egnmod(3,i) = ro(i)
+	  egnmod(4,i) = vps(i)
+	  dpt = dpt + d(i)
+	enddo
+
+	call flat(jcom,iefl)
+	noc = 1
+	if (vss(1).le.0.d0) noc = 2
+
+	cmin = 0.6d0*vss(noc)
+	cmin = dmin1(cmin,vps(1))
+	cmn = dmax1(c1,cmin)
+
+	do i = 1,n
+	  vss(i) = vss(i)*vss(i)
+	  vps(i) = vps(i)*vps(i)
+	enddo
+
+	dom  = tpi*df
+	nh   = nom
+	omax = tpi*fo + nh*dom
+	om   = omax - dom
+	call qcor(om,omref)
+
+	cmax = dsqrt(vs(n)) - 1.d-8
+	ctst = c2
+	if (ctst.le.0.d0) ctst = cmax
+	cmx = dmin1(ctst,cmax)
+	cmaxi = cmx
+	nbr2 = nbran2
+	call detk(cmaxi,om,kei,dei,jcom)
+	if (ierr.ne.0) return
+	if (nbr2.lt.0.or.nbr2.ge.kei) nbr2 = kei - 1
+	nbran = max0((nbr2 - nbran1 + 1),1)
+
+c -- at most one block per period of each mode, plus the ensured period
+	maxblk = nbran*(nh + 1)
+	if (allocated(disp)) deallocate(disp)
+	if (allocated(egnhead)) deallocate(egnhead)
+	if (allocated(egny)) deallocate(egny)
+	allocate(disp(6,maxblk),egnhead(6,maxblk),egny(ncol,nlay,maxblk))
+
+	nb = nbran1
+c  Start with the lower mode, come back here for the next higher mode when this mode is done
+30	ctry = 0.5d0*(cmn + cmx)
+	ceps = 0.5d0*(cmx - ctry)
+	cm = 0.d0
+	iusr = 1
+	do i = 1,nh
+	  om = omax - i*dom
+	  omuse = om
+	  if (iusr.le.1 .and. usrom.gt.om) then
+	    omuse = usrom
+	    iusr = iusr + 1
+	  endif
+	  call qcor(omuse,omref)
+	  cmax = dsqrt(vs(n)) - 1.d-8
+	  ctst = c2
+	  if (ctst.le.0.d0) ctst = cmax
+	  cmx = dmin1(ctst,cmax)
+	  call warm(cwarm,nwm,nwf,wtol,nb-nbran1+1,i)
+	  call cex(omuse,nb,jcom,nev)
+	  if (ierr.ne.0) go to 50
+	  if (nev.eq.0) go to 40
+	  call intrp(omuse,dom,jcom)
+	  if (ierr.ne.0) go to 50
+	enddo
+40	nb = nb + 1
+	if (nb.le.nbr2) go to 30
+
+	return
+
+c -- error where the earthsr program stops, see store_err
+50	if (errnord.lt.0) errnord = nb
+	return
+	end
+
+	subroutine store_egn(nord,ls,per,cc,u,fnorm,x,nx)
+c  keeps the eigenfunctions x of mode nord at period per in earthsr_mem
+	use earthsr_mem
+
+	implicit real*8 (a-h, o-z)
+
+	dimension x(nx,*)
+
+	negn = negn + 1
+	egnhead(1,negn) = nord
+	egnhead(2,negn) = ls
+	egnhead(3,negn) = per
+	egnhead(4,negn) = cc
+	egnhead(5,negn) = u
+	egnhead(6,negn) = fnorm
+	do ic = 1,nlay
+	  do ir = 1,ncol
+	    egny(ir,ic,negn) = x(ir,min(ic,ls))
+	  enddo
+	enddo
+
+	return
+	end
+
+	subroutine store_err(icode,nord,per)
+c  keeps the error icode of mode nord at period per in earthsr_mem, instead
+c  of the stop of the earthsr program that would end the python process
+	use earthsr_mem
+
+	implicit real*8 (a-h, o-z)
+
+	if (ierr.ne.0) return
+	ierr    = icode
+	errnord = nord
+	errper  = per
+
+	return
+	end
+
+	subroutine store_disp(nord,per,cc,u,q,flan)
+c  keeps the dispersion of mode nord at period per in earthsr_mem
+	use earthsr_mem
+
+	implicit real*8 (a-h, o-z)
+
+	ndisp = ndisp + 1
+	disp(1,ndisp) = nord
+	disp(2,ndisp) = per
+	disp(3,ndisp) = cc
+	disp(4,ndisp) = u
+	disp(5,ndisp) = q
+	disp(6,ndisp) = flan
+
+	return
+	end
@@ -10,6 +10,7 @@ c     +   '/home/keith/codes/surface_waves/earth/common_files/sizes.inc'
       common/y/y1,y2,y3,y4,y5
       common/m/d(lyrs),ro(lyrs),vp2(lyrs),vs2(lyrs),
      +          fu(lyrs),n,noc,ist
+      common/bin/ibin,ider
       dimension y(5),x(5)
       equivalence (y,y1)
       data tpi/6.2831853071796d0/
@@ -84,6 +85,11 @@ c**** propagate up layers ****
       if(isplit.lt.100)go to 50
       write(*,998) i, isplit
   998 format(' count problem in layer ',i5,' isplit is ',i5)
+c  in-process earthsr (earthsr_py.f): the error is returned instead
+      if(ibin.eq.2) then
+        call store_err(2,-1,tpi/w)
+        return
+      endif
       stop
    10 tes=t1*(y(5)-x(5))
       if(tes.lt.0.d0) kount=kount+1
@@ -204,6 +210,7 @@ c     +   '/home/keith/codes/surface_waves/earth/common_files/units.inc'
 
       subroutine cex(om,nb,jcom,nev)
 c  makes sure branch nb is isolated given ctry+-ceps as trial c
+      use earthsr_mem, only: ierr
       implicit real*8(a-h,o-z)
 c      include 
 c    +   '/home/keith/codes/surface_waves/earth/common_files/sizes.inc'
@@ -222,6 +229,7 @@ c*** bracket this mode ***
     5 if(ke(2)-ke(1).eq.1) goto 50
       cx=dmin1(dmax1(cx,cmn),cmx)
       call detk(cx,om,kx,dx,jcom)
+      if(ierr.ne.0) return
       if(kx.ge.nup) goto 30
       if(cx.ge.cmx) return
       if(kx.ne.nb.or.ke(1).ne.nb) goto 10
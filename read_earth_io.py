@@ -9,9 +9,11 @@ import re
 import gzip
 import sys
 import math
+import hashlib
+import shutil
+import warnings
 import numpy as np
 import matplotlib.pyplot as plt
-from pdb import set_trace as bp
 
 # Modules written by me
 
@@ -201,6 +203,232 @@ class read_modfile:
         
 ###################################################################################################################
 
+def open_egnfile(infile):
+
+        """ Opens an eigenfunction file (possibly gzipped) in binary mode, so that byte offsets can be used """
+
+        if infile.endswith('.gz'):
+                    return gzip.GzipFile(infile,'rb')
+        else:
+                    return open(infile,'rb')
+
+def read_egnfile_model(egn_contents):
+
+        """ Reads the model at the top of an eigenfunction file opened with open_egnfile and not read yet.
+            Returns a dict containing depth, mu, lamda and rho of each layer
+        """
+
+        # First line in the file is a string
+        egn_contents.readline()
+        # Second line contains number of layers
+        model_deps = int(egn_contents.readline().split()[0])
+        rows   = b''.join([egn_contents.readline() for i in range(model_deps)])
+        values = np.fromstring(rows, sep=' ').reshape(model_deps, 4)
+        model = {}
+        model['dep']   = values[:,0].copy()
+        model['rho']   = values[:,2].copy()
+        alpha = values[:,3]
+        beta  = values[:,1]
+        model['mu']    = model['rho']*(beta**2)
+        model['lamda'] = model['rho']*(alpha**2)-(2*model['mu'])
+
+        return model
+
+####################################################################################################################
+
+# One entry per 7-column block header of an eigenfunction file
+egn_index_dtype = np.dtype([('mode', 'i4'), ('period', 'f8'), ('cphi', 'f8'), ('ls', 'i4'), ('offset', 'i8')])
+
+def name_egnfile_index(infile):
+
+        return infile + '.idx.npy'
+
+def build_egnfile_index(infile):
+
+        """ Goes once through an eigenfunction file and records the mode number, period, phase velocity, number
+            of layers (ls) and byte offset of every 7-column block header. Only the header lines are tokenized,
+            the eigenfunction rows are skipped. The index is saved in a sidecar file next to the eigen file
+            (see name_egnfile_index) so that later readers can seek straight to the blocks they need
+        """
+
+        egn_contents = open_egnfile(infile)
+        ncol_ph=7
+        read_egnfile_model(egn_contents)
+
+        index       = []
+        row_bytes   = 0
+        line_offset = egn_contents.tell()
+        line        = egn_contents.readline()
+        while line:
+
+                values_line = line.split()
+                if len(values_line)==ncol_ph and not values_line[0].isalpha():
+
+                        lyrsthism = int(values_line[5])
+                        index.append( (int(values_line[0]), float(values_line[1]), float(values_line[2]), lyrsthism, line_offset) )
+
+                        # Rows are written with a fixed Fortran format, so the block is skipped with a single
+                        # seek once the row length is known. If the next line is not where it should be, fall
+                        # back to skipping the rows one by one
+                        offset = egn_contents.tell()
+                        if not row_bytes:
+                                row_bytes = len(egn_contents.readline())
+                        egn_contents.seek(offset + lyrsthism*row_bytes)
+                        line_offset = egn_contents.tell()
+                        line        = egn_contents.readline()
+                        if line and not (len(line.split())==ncol_ph or b'mode' in line):
+                                egn_contents.seek(offset)
+                                for j in range(lyrsthism):
+                                        egn_contents.readline()
+                                line_offset = egn_contents.tell()
+                                line        = egn_contents.readline()
+                        continue
+
+                line_offset = egn_contents.tell()
+                line        = egn_contents.readline()
+
+        egn_contents.close()
+
+        index = np.array(index, dtype=egn_index_dtype)
+        np.save(name_egnfile_index(infile), index)
+
+        return index
+
+def load_egnfile_index(infile):
+
+        """ Returns the block index of an eigenfunction file. The sidecar file is used when it is more recent
+            than the eigen file, otherwise the index is built (again)
+        """
+
+        name_index = name_egnfile_index(infile)
+        if os.path.isfile(name_index) and os.path.getmtime(name_index) >= os.path.getmtime(infile):
+                return np.load(name_index)
+
+        return build_egnfile_index(infile)
+
+def parse_egn_rows(rows):
+
+        """ Converts rows of an eigen file at once. Returns None when the rows cannot be parsed entirely, i.e.
+            exponents with 3 digits that Fortran writes without the 'E' (e.g. 1.0-100) or text from another block
+        """
+
+        if re.search(rb'\d[+-]\d{3}', rows):
+                return None
+
+        with warnings.catch_warnings():
+                warnings.simplefilter('error', DeprecationWarning)
+                try:
+                        return np.fromstring(rows, sep=' ')
+                except (ValueError, DeprecationWarning):
+                        return None
+
+def read_egnfile_block(egn_contents, offset):
+
+        """ Reads the block whose header line starts at byte offset. Returns an array with one row per layer
+            containing the depth followed by the eigenfunction components (4 for Rayleigh, 2 for Love)
+        """
+
+        egn_contents.seek(offset)
+        lyrsthism = int(egn_contents.readline().split()[5])
+        first_row = egn_contents.readline()
+        ncol      = len(first_row.split())
+
+        # Rows are written with a fixed Fortran format, so the rest of the block is read in a single call
+        # and converted at once
+        rows   = first_row + egn_contents.read((lyrsthism-1)*len(first_row))
+        values = parse_egn_rows(rows)
+        if values is None or not (rows.endswith(b'\n') and values.size==lyrsthism*ncol):
+                # Rows of unexpected width, or exponents with 3 digits that Fortran writes without the 'E'
+                egn_contents.seek(offset)
+                egn_contents.readline()
+                rows   = b''.join([egn_contents.readline() for j in range(lyrsthism)])
+                values = np.fromstring(re.sub(rb'(\d)([+-]\d{3})', rb'\1E\2', rows), sep=' ')
+
+        return values.reshape(lyrsthism, ncol)
+
+def read_egnfile_period(egn_contents, blocks_per, wavnum, ymat):
+
+        """ Reads all the blocks of one period into wavnum (mode) and ymat (eigenfunction component, depth, mode),
+            which are filled in place. blocks_per is a list of (mode column, byte offset of the header, layers in
+            this block, wavenumber) tuples. Returns the number of components in the blocks (4 Rayleigh, 2 Love)
+        """
+
+        ncomp = ymat.shape[0]
+        for k, offset, lyrsthism, kn in blocks_per:
+
+                values = read_egnfile_block(egn_contents, offset)
+                ncomp  = values.shape[1]-1
+                ymat[:ncomp,:lyrsthism,k] = values[:,1:].T
+                # Below the deepest layer of this mode, eigenfunctions keep their last value
+                ymat[:ncomp,lyrsthism:,k] = values[-1:,1:].T
+                wavnum[k] = kn
+
+        return ncomp
+
+####################################################################################################################
+
+class period_index:
+
+        """ Index of a list of periods (e.g. the periods requested from an eigenfunction file), built once so that
+            each period read from a file is matched in O(1) (exact) or O(log P) (tolerance, nearest, above)
+            instead of being compared with the whole list
+
+            Exact matches account for the precision with which periods are written in the eigen file: a period
+            matches if it agrees to 7 decimals, or to 5 decimals with the requested period rounded or truncated.
+            The first of several equal periods in the list is returned
+        """
+
+        def __init__(self, periods):
+                self.periods = np.asarray(periods, dtype=float).ravel()
+                self.order   = np.argsort(self.periods, kind='stable')
+                self.sorted  = self.periods[self.order]
+
+                self.keys_7th = {}
+                self.keys_5th = {}
+                for iper, per in enumerate(self.periods.tolist()):
+                        self.keys_7th.setdefault(round(per,7), iper)
+                        for key in [round(per,5), round(round(per,6),5), truncate(per,5)]:
+                                self.keys_5th.setdefault(key, iper)
+
+        def exact(self, per):
+
+                """ Position in the list of the period matching per, None if there is none """
+
+                per  = float(per)
+                iper = self.keys_7th.get(round(per,7))
+                if iper is None:
+                        iper = self.keys_5th.get(round(per,5))
+                return iper
+
+        def within(self, per, tol):
+
+                """ Positions in the list of the periods within tol of per, by increasing period """
+
+                ilow  = np.searchsorted(self.sorted, per - tol, side='left')
+                ihigh = np.searchsorted(self.sorted, per + tol, side='right')
+                return self.order[ilow:ihigh]
+
+        def nearest(self, per):
+
+                """ Position in the list of the period closest to per, None if the list is empty """
+
+                if self.sorted.size == 0:
+                        return None
+                ipos = np.searchsorted(self.sorted, per)
+                candidates = self.order[max(ipos-1,0):ipos+1]
+                return candidates[np.argmin(abs(self.periods[candidates] - per))]
+
+        def above(self, per):
+
+                """ Position in the list of the shortest period >= per, None if all periods are shorter """
+
+                ipos = np.searchsorted(self.sorted, per, side='left')
+                if ipos == self.sorted.size:
+                        return None
+                return self.order[ipos]
+
+####################################################################################################################
+
 class read_egnfile:
         
         """ Reads the eigenfunction for a specified mode and period from one or more eigenfunction files
@@ -213,12 +441,12 @@ class read_egnfile:
         def __init__(self,flist,m_concerned,p_concerned):
                 self.mpp = m_concerned
                 self.ppp = p_concerned
-                self.uz=range(len(flist))
-                self.ur=range(len(flist))
-                self.tz=range(len(flist))
-                self.tr=range(len(flist))
-                self.ut=range(len(flist))
-                self.tt=range(len(flist))
+                self.uz=[None for fl in flist]
+                self.ur=[None for fl in flist]
+                self.tz=[None for fl in flist]
+                self.tr=[None for fl in flist]
+                self.ut=[None for fl in flist]
+                self.tt=[None for fl in flist]
                 for fn,fl in enumerate(flist):
                         allcomp=self.read_single_file(fl)
                         try:
@@ -233,123 +461,49 @@ class read_egnfile:
                                 pass
 
         def read_single_file(self,inyifile):
-                moddep=self.parse_file(inyifile)
-                x=self.pick_right_slice()
+                self.parse_file(inyifile)
+                x=self.pick_right_slice(inyifile)
                 return x
         def parse_file(self,egn_file):
 
-                """ Goes through the eigen file & reads it into memory. Returns a list containing 
-                       the entire file below the lines containing the model at the top
-
-                    In the eigen file each mode has a header of two lines (specifying number of periods) and each
-                    period has a header of 1 line
+                """ Loads the index of the (mode, period) blocks of the eigen file, see load_egnfile_index.
+                    The file itself is only read once the right block is known
                 """
 
-                if egn_file.endswith('.gz'):
-                            egn_contents = gzip.GzipFile(egn_file,'r')
-                else:
-                            egn_contents = open(egn_file,'r')
-        
-                #print( "=================> ",egn_file)
-                
-                dep=[]
-                ncol_ph=7
-                # First line in the file is a string
-                egn_contents.readline()
-                # Second line specifies number of layers in model
-                model_lines = int(egn_contents.readline().split()[0])
-
-                # Read the file into memory but get rid of the initial model-specifying part
-                egn_entire=egn_contents.readlines()
-                for i,line in enumerate(egn_entire):
-                        if i < model_lines: 
-                                values_line = line.split()
-                                dep.append(float(values_line[0]))
-                        else: break
-                #del egn_entire[:model_lines]
-                self.whole_egn = egn_entire[model_lines+2:]
+                self.egn_index = load_egnfile_index(egn_file)
                 # Get the period samples for each mode
-                self.nps=[]
-                self.ps=[]
-                ps_mode=[]
-                for line in self.whole_egn:
-                        if "samples" in line.split():
-                                self.nps.append(int(line.split()[1]))
-                                if __name__=='__main__':
-                                        print( "no. of periods is ", self.nps[-1])
-                        if (len(line.split())==ncol_ph) and (not line.split()[2].isalpha()):
-                                per=float(line.split()[1])
-                                per_lines=int(line.split()[-2])
-                                ps_mode.append([per,per_lines])
-                        #        print( "length of ps_mode is ", len(ps_mode))
-                        if len(ps_mode)==self.nps[-1]:
-                                if __name__=='__main__':
-                                        print("Found mode %d" %(len(self.ps)))
-                                self.ps.append(ps_mode)
-                                ps_mode=[]
-                #print self.nps, self.ps
-                self.modes_lines=[]
-                for ps_m in self.ps:
-                        m_lines = sum([y for x,y in ps_m]) + (len(ps_m)) + 2
-                        self.modes_lines.append(m_lines)
-                egn_contents.close()
-                del egn_contents
-                return np.array(dep)
+                self.nps = [ np.count_nonzero(self.egn_index['mode']==mode) for mode in np.unique(self.egn_index['mode']) ]
+                if __name__=='__main__':
+                        print( "no. of periods per mode is ", self.nps)
 
-        def pick_right_slice(self):
+        def pick_right_slice(self,egn_file):
 
-                result=range(6)
-                islov = False
-                isray = False                
-                modes = range(len(self.nps))
-                prev_mlines = sum([ self.modes_lines[x] for x,y in enumerate(modes) if y<self.mpp ])
+                result=[None for i in range(6)]
                 if __name__=='__main__':
                         print( "mpp & ps are ", self.mpp)
-                prev_ps = [y for x,y in self.ps[self.mpp] if x<self.ppp]
-                prev_plines = sum(prev_ps) + len(prev_ps)
-                prev_lines = int(prev_mlines + prev_plines)
-                try:
-                        self.ppp = float(self.whole_egn[prev_lines+1].split()[1])
-                        print( "Extracting eigenfunctions for mode %d, period %f" %(self.mpp,self.ppp))
-                except (ValueError, IndexError):
+                in_mode = self.egn_index[ self.egn_index['mode']==self.mpp ]
+                iper    = period_index(in_mode['period']).above(self.ppp)
+                if iper is None:
                         if __name__ == '__main__':
                                 sys.exit("Mode number %d does not exist at this period !!" %(self.mpp))
                         else:
                                 return 1
-                rel_lines = self.ps[self.mpp][len(prev_ps)][1]
-                rel_slice = self.whole_egn[(prev_lines+1):(prev_lines+1+rel_lines+1)]
+                self.ppp = in_mode['period'][iper]
+                print( "Extracting eigenfunctions for mode %d, period %f" %(self.mpp,self.ppp))
                 nfac=1 #float(rel_slice[0].split()[-4])
                 print( "From reo: nfac is ", nfac)
-                d=[]
-                y1=[]
-                y2=[]
-                y3=[]
-                y4=[]
-                for line in rel_slice[1:]:
-                        values_line = [ float(i) for i in line.split() ]
-                        d.append(values_line[0])
-                        y1.append(nfac*values_line[1])
-                        y2.append(nfac*values_line[2])
-                        try:
-                                y3.append(nfac*values_line[3])
-                                y4.append(nfac*values_line[4])
-                                isray = True
-                        except IndexError:
-                                islov = True
-                if isray:
-                        result[0]=zip(d,y1)
-                        result[1]=zip(d,y2)
-                        result[2]=zip(d,y3)
-                        result[3]=zip(d,y4)
-                        result[4]=None
-                        result[5]=None
-                elif islov:
-                        result[4]=zip(d,y1)
-                        result[5]=zip(d,y2)
-                        result[0]=None
-                        result[1]=None
-                        result[2]=None
-                        result[3]=None
+                egn_contents = open_egnfile(egn_file)
+                values = nfac*read_egnfile_block(egn_contents, in_mode['offset'][iper])
+                egn_contents.close()
+                d = values[:,0]/nfac
+                if values.shape[1]==5:
+                        result[0]=list(zip(d,values[:,1]))
+                        result[1]=list(zip(d,values[:,2]))
+                        result[2]=list(zip(d,values[:,3]))
+                        result[3]=list(zip(d,values[:,4]))
+                else:
+                        result[4]=list(zip(d,values[:,1]))
+                        result[5]=list(zip(d,values[:,2]))
                 return result
                 
 ####################################################################################################################
@@ -365,138 +519,152 @@ class read_egnfile_per:
             to the one requested """
         
         def __init__(self,infile,p_concerned):
-                if infile.endswith('.gz'):
-                            egn_contents = gzip.GzipFile(infile,'r')
-                else:
-                            egn_contents = open(infile,'r')
-                ncol_ph=7
-                
-                # First line in the file is a string
-                egn_contents.readline()
-                # Second line contains number of layers
-                model_deps = int(egn_contents.readline().split()[0])
-                self.dep=np.arange(model_deps,dtype=float)
-                self.mu=np.arange(model_deps,dtype=float)
-                self.lamda=np.arange(model_deps,dtype=float)
-                self.rho=np.arange(model_deps,dtype=float)
-                alpha=[ii for ii in range(model_deps)]
-                beta=[ii for ii in range(model_deps)]
-                #self.rho=range(model_deps)
-                i=0
-                j=0
-                k=0
-                startreading=False
-                cptt=0
-                
-                for line in egn_contents:
-                
-                        cptt=cptt+1
-                        if i < model_deps:      
-                                values_line = line.split()
-                                self.dep[i]=float(values_line[0])
-                                alpha[i]=float(values_line[3])
-                                beta[i]=float(values_line[1])
-                                self.rho[i]=float(values_line[2])
-                                self.mu[i]=self.rho[i]*(beta[i]**2)
-                                self.lamda[i]=self.rho[i]*(alpha[i]**2)-(2*self.mu[i])
-                                i+=1
-                                
-                        if "modes listed" in line:
-                                self.totm=int(line.split()[0])
-                                self.wavnum=np.zeros(self.totm)
-                                self.uzmat=np.zeros((model_deps,self.totm))
-                                self.urmat=np.zeros((model_deps,self.totm))
-                                self.tzmat=np.zeros((model_deps,self.totm))
-                                self.trmat=np.zeros((model_deps,self.totm))
-                                self.utmat=np.zeros((model_deps,self.totm))
-                                self.ttmat=np.zeros((model_deps,self.totm))
-                                
-                        if startreading:
-                        
-                                values_line = [ float(i) for i in line.split() ]
-                                y1[j]=values_line[1]
-                                y2[j]=values_line[2]
-                                
-                                try:
-                                        y3[j]=values_line[3]
-                                        y4[j]=values_line[4]
-                                        isray=True
-                                        islov=False
-                                except IndexError:
-                                        islov=True
-                                        isray=False
-                                        
-                                j+=1
-                                if j==lyrsthism:
-                                        startreading=False
-                                        if isray:
-                                                self.uzmat[:len(y1),k]=y1
-                                                self.urmat[:len(y2),k]=y2
-                                                self.tzmat[:len(y3),k]=y3
-                                                self.trmat[:len(y4),k]=y4
-                                                
-                                                self.uzmat[len(y1):len(self.uzmat[:,k]),k]=y1[len(y1)-1]
-                                                self.urmat[len(y2):len(self.urmat[:,k]),k]=y2[len(y2)-1]
-                                                self.tzmat[len(y3):len(self.tzmat[:,k]),k]=y3[len(y3)-1]
-                                                self.trmat[len(y4):len(self.trmat[:,k]),k]=y4[len(y4)-1]
-                                                
-                                                self.utmat=None
-                                                self.ttmat=None
-                                        elif islov:
-                                                self.utmat[:len(y1),k]=y1
-                                                self.ttmat[:len(y2),k]=y2
-                                                self.uzmat=None
-                                                self.urmat=None
-                                                self.tzmat=None
-                                                self.trmat=None
-                                        k+=1
-
-                        if (len(line.split())==ncol_ph) and (not line.split()[0].isalpha()):
-                        
-                                perto5th=round(float(line.split()[1]),5)
-                                perto7th=round(float(line.split()[1]),7)
-                                saveline = line
-                                if perto5th==round(round(p_concerned,6),5) or perto5th==round(p_concerned,5) \
-                                        or perto7th==round(p_concerned,7) or perto5th==truncate(p_concerned,5):
-                                
-                                        if __name__=='__main__':
-                                                print( "Extracting eigenfunction for mode %d and period %.6f" %(int(line.split()[0]),float(line.split()[1])))
-                                        j=0
-                                        self.wavnum[k]=2*np.pi/(p_concerned*float(line.split()[2]))
-                                        lyrsthism=int(line.split()[5])
-                                        startreading=True
-                                        save_mode=int(line.split()[0])
-                                        y1=np.arange(lyrsthism,dtype=float)
-                                        y2=np.arange(lyrsthism,dtype=float)
-                                        y3=np.arange(lyrsthism,dtype=float)
-                                        y4=np.arange(lyrsthism,dtype=float)
-
-                # At this stage, i.e. after the entire file has been read, the value of k will be equal to the number
-                # of modes that exist (are present in the file) for the given period. The matrices containing the 
-                # eigenfunctions (each column of matrix = separate mode) should therefore be trimmed down to k
-                # columns. This is done by the function final_result
-                try:
-                        self.final_result(k,isray)
-                except:
-                        bp()
-                        
-        def final_result(self,relm,ray):
-                
-                extracols=np.arange(relm,self.totm)
-                self.wavnum=np.delete(self.wavnum,extracols)
-                if ray:
-                        self.uzmat=np.delete(self.uzmat,extracols,1)
-                        self.urmat=np.delete(self.urmat,extracols,1)
-                        self.tzmat=np.delete(self.tzmat,extracols,1)
-                        self.trmat=np.delete(self.trmat,extracols,1)
-                        
+                egn_contents = open_egnfile(infile)
+                model = read_egnfile_model(egn_contents)
+                self.dep   = model['dep']
+                self.mu    = model['mu']
+                self.lamda = model['lamda']
+                self.rho   = model['rho']
+                model_deps = len(self.dep)
+
+                # Only the blocks at the requested period are read, the others are located with the index
+                egn_index = load_egnfile_index(infile)
+                self.totm = np.unique(egn_index['mode']).size
+                p_index = period_index([p_concerned])
+                blocks_per = []
+                for block in egn_index:
+                        if p_index.exact(block['period']) is not None:
+                                if __name__=='__main__':
+                                        print( "Extracting eigenfunction for mode %d and period %.6f" %(block['mode'],block['period']))
+                                blocks_per.append( (len(blocks_per), block['offset'], block['ls'], 2*np.pi/(p_concerned*block['cphi'])) )
+
+                self.wavnum = np.zeros(len(blocks_per))
+                ymat  = np.zeros((4,model_deps,len(blocks_per)))
+                isray = read_egnfile_period(egn_contents, blocks_per, self.wavnum, ymat)==4
+                egn_contents.close()
+                if isray:
+                        self.uzmat, self.urmat, self.tzmat, self.trmat = ymat
+                        self.utmat=None
+                        self.ttmat=None
                 else:
-                        self.utmat=np.delete(self.utmat,extracols,1)
-                        self.ttmat=np.delete(self.ttmat,extracols,1)
-   
+                        self.utmat, self.ttmat = ymat[:2]
+                        self.uzmat=None
+                        self.urmat=None
+                        self.tzmat=None
+                        self.trmat=None
+
+####################################################################################################################
+
+def scan_egnfile(infile, p_concerned_list):
+
+        """ Locates, for every requested period, the block of each mode in an eigenfunction file. Blocks are
+            found with the index of the file (see load_egnfile_index), so the file is scanned at most once
+
+            Returns the model as a dict (dep, mu, lamda, rho) and, for each period of p_concerned_list, a list
+            of (mode column, byte offset of the header, layers in this block, wavenumber) tuples that
+            read_egnfile_blocks uses to read the blocks back
+        """
+
+        egn_contents = open_egnfile(infile)
+        model = read_egnfile_model(egn_contents)
+        egn_contents.close()
+        egn_index = load_egnfile_index(infile)
+
+        p_index = period_index(p_concerned_list)
+
+        # Columns follow the order in which modes appear in the file
+        modes, cols = np.unique(egn_index['mode'], return_inverse=True)
+        blocks = [[] for p_temp in p_concerned_list]
+        for k, block in zip(cols, egn_index):
+                iper = p_index.exact(block['period'])
+                if iper is not None:
+                        perto7th = round(float(block['period']),7)
+                        blocks[iper].append( (k, block['offset'], block['ls'], 2*np.pi/(perto7th*block['cphi'])) )
+
+        return model, blocks
+
+####################################################################################################################
+
+def set_egnfile_components(reoobj, ymat):
+
+        """ Sets the eigenfunction attributes of reoobj from ymat (component, ...): uzmat, urmat, tzmat and trmat
+            for Rayleigh, utmat and ttmat for Love, the others being None
+        """
+
+        if ymat.shape[0]==4:
+                reoobj.uzmat, reoobj.urmat, reoobj.tzmat, reoobj.trmat = ymat
+                reoobj.utmat = None
+                reoobj.ttmat = None
+        else:
+                reoobj.utmat, reoobj.ttmat = ymat
+                reoobj.uzmat = None
+                reoobj.urmat = None
+                reoobj.tzmat = None
+                reoobj.trmat = None
+
+def extend_egn_depths(reoobjs):
+
+        """ Extends the eigenfunctions of several parsed eigenfunction files, computed with models that only differ
+            by their depth (see RW_dispersion.compute_dispersion_in_bands), to the layers of the deepest model.
+            Eigenfunctions are taken as zero below the deepest layer of a shallower model. A shallower model stops
+            band_depth_efolds e-folding lengths below the depth where its modes become evanescent, so that the jump
+            at its bottom is that much smaller than the eigenfunctions above. Sources and receivers lie above the
+            bottom, so that only I1 and the eigenfunctions below it differ from a run with the whole model
+        """
+
+        deepest    = max(reoobjs, key=lambda reoobj: len(reoobj.dep))
+        model_deps = len(deepest.dep)
+        for reoobj in reoobjs:
+                deps = len(reoobj.dep)
+                if deps == model_deps:
+                        continue
+                if not np.array_equal(reoobj.dep, deepest.dep[:deps]):
+                        sys.exit('Eigenfunctions computed on models with different layers can not be merged')
+                for key in ['uzmat', 'urmat', 'tzmat', 'trmat', 'utmat', 'ttmat']:
+                        ymat = getattr(reoobj, key)
+                        if ymat is not None:
+                                setattr(reoobj, key, np.concatenate([ymat, np.zeros((ymat.shape[0], model_deps-deps, ymat.shape[2]), dtype=ymat.dtype)], axis=1))
+                for key in egn_cache_model:
+                        setattr(reoobj, key, getattr(deepest, key))
+
+class read_egnfile_blocks:
+
+        """ Class to read, FOR ALL MODES AT A LIST OF PERIODS, the eigenfunction blocks located beforehand by
+            scan_egnfile. The file is never parsed from the top, so several instances can share the work of a
+            single scan
+
+            Eigenfunctions are stored in contiguous (period, depth, mode) arrays of type dtype, and wavenumbers in
+            a (period, mode) array. Only the first nmodes[iperiod] modes of a period are valid, e.g.
+            uzmat[iperiod,:,:nmodes[iperiod]]
+
+        NB: blocks is the part of the output of scan_egnfile corresponding to the periods wanted here """
+
+        def __init__(self, infile, model, blocks, dtype=np.float64):
+                egn_contents = open_egnfile(infile)
+
+                self.dep   = model['dep']
+                self.mu    = model['mu']
+                self.lamda = model['lamda']
+                self.rho   = model['rho']
+                model_deps = len(self.dep)
+
+                self.nmodes = np.array([max([block[0] for block in blocks_per]) + 1 if blocks_per else 0 for blocks_per in blocks], dtype=int)
+                totm  = self.nmodes.max() if self.nmodes.size else 0
+                # Number of components (4 Rayleigh, 2 Love) from the first block, so that Love runs allocate only two
+                first = [blocks_per[0][1] for blocks_per in blocks if blocks_per]
+                ncomp = read_egnfile_block(egn_contents, first[0]).shape[1]-1 if first else 4
+
+                self.wavnum = np.zeros((len(blocks),totm))
+                ymat = np.zeros((ncomp,len(blocks),model_deps,totm), dtype=dtype)
+                for iper, blocks_per in enumerate(blocks):
+                        read_egnfile_period(egn_contents, blocks_per, self.wavnum[iper], ymat[:,iper])
+                egn_contents.close()
+
+                set_egnfile_components(self, ymat)
+
 ####################################################################################################################
 
-class read_egnfile_allper:
+class read_egnfile_allper(read_egnfile_blocks):
 
         """ Class to read a single eigenfunction file and extract the eigenfunction FOR ALL MODES AT A SPECIFIED
             PERIOD
@@ -504,201 +672,210 @@ class read_egnfile_allper:
         NB: The difference between this class and the read_egnfile class in terms of operation is that this
             class will find all EXACT periods """
         
-        def __init__(self,infile, p_concerned_list, Nproc):
-                if infile.endswith('.gz'):
-                            egn_contents = gzip.GzipFile(infile,'r')
+        def __init__(self,infile, p_concerned_list, Nproc=1, dtype=np.float64):
+                model, blocks = scan_egnfile(infile, p_concerned_list)
+                read_egnfile_blocks.__init__(self, infile, model, blocks, dtype)
+
+####################################################################################################################
+
+def egn_bin_model(values):
+
+        """ Model dict (dep, mu, lamda, rho) from the (depth, vs, rho, vp) rows of the layers """
+
+        model = {}
+        model['dep']   = values[:,0]
+        model['rho']   = values[:,2]
+        alpha = values[:,3]
+        beta  = values[:,1]
+        model['mu']    = model['rho']*(beta**2)
+        model['lamda'] = model['rho']*(alpha**2)-(2*model['mu'])
+
+        return model
+
+def egn_bin_dtype(model_deps, ncol):
+
+        """ Type of the (mode, period) blocks of a binary eigenfunction file """
+
+        return np.dtype([('mode', '<i4'), ('ls', '<i4'), ('period', '<f8'), ('cphi', '<f8'), ('cg', '<f8'),
+                         ('norm', '<f8'), ('y', '<f8', (model_deps, ncol))])
+
+def open_egnfile_bin(infile):
+
+        """ Memory-maps a binary eigenfunction file, written by earthsr when the first line of its input ends
+            with ibin = 1 (see earthsr.f). Returns the model as a dict (dep, mu, lamda, rho) and a structured
+            array with one entry per (mode, period) block: mode, ls, period, cphi, cg, norm and y, the
+            eigenfunction components (4 for Rayleigh, 2 for Love) on all layers of the model
+        """
+
+        model_deps, ncol = np.fromfile(infile, dtype='<i4', count=2)
+        values = np.fromfile(infile, dtype='<f8', count=model_deps*4, offset=8).reshape(model_deps, 4)
+        model  = egn_bin_model(values)
+
+        block_dtype = egn_bin_dtype(model_deps, ncol)
+        offset  = 8 + values.nbytes
+        nblocks = (os.path.getsize(infile) - offset) // block_dtype.itemsize
+        if offset + nblocks*block_dtype.itemsize != os.path.getsize(infile):
+                sys.exit('Binary eigenfunction file %s is truncated' % (infile))
+        if nblocks == 0:
+                return model, np.zeros(0, dtype=block_dtype)
+
+        return model, np.memmap(infile, dtype=block_dtype, mode='r', offset=offset, shape=(nblocks,))
+
+def open_derbin(infile):
+
+        """ Memory-maps a binary partial derivatives file, written by earthsr when the first line of its input
+            ends with ider = 1 (see earthsr.f). Returns the depths of the top of the layers, once split at the
+            source and receiver depths, and a structured array with one entry per (mode, period) block: mode,
+            ls, period, cphi, cg and der, the log derivatives of phase velocity w.r.t. rho, vp and vs (rho and
+            vs for Love) on all layers
+        """
+
+        model_deps, npar = np.fromfile(infile, dtype='<i4', count=2)
+        values = np.fromfile(infile, dtype='<f8', count=model_deps*4, offset=8).reshape(model_deps, 4)
+
+        block_dtype = np.dtype([('mode', '<i4'), ('ls', '<i4'), ('period', '<f8'), ('cphi', '<f8'), ('cg', '<f8'),
+                                ('der', '<f8', (model_deps, npar))])
+        offset  = 8 + values.nbytes
+        nblocks = (os.path.getsize(infile) - offset) // block_dtype.itemsize
+        if offset + nblocks*block_dtype.itemsize != os.path.getsize(infile):
+                sys.exit('Binary partial derivatives file %s is truncated' % (infile))
+        if nblocks == 0:
+                return values[:,0], np.zeros(0, dtype=block_dtype)
+
+        return values[:,0], np.memmap(infile, dtype=block_dtype, mode='r', offset=offset, shape=(nblocks,))
+
+def read_earthsr_mem(earthsr_mem):
+
+        """ Copies the outputs of the in-process earthsr (module earthsr_mem of the earthsr_ext extension, see
+            earthsr_py.f) once earthsr_compute has run. Returns the dispersion table, with the same columns
+            as the disp_vconly file, and the model and blocks of eigenfunctions as returned by open_egnfile_bin
+        """
+
+        disp   = np.array(earthsr_mem.disp[:,:earthsr_mem.ndisp].T)
+        model  = egn_bin_model(np.array(earthsr_mem.egnmod.T))
+        nblocks = int(earthsr_mem.negn)
+        blocks = np.zeros(nblocks, dtype=egn_bin_dtype(int(earthsr_mem.nlay), int(earthsr_mem.ncol)))
+        if nblocks > 0:
+                head = earthsr_mem.egnhead[:,:nblocks]
+                for irow, key in enumerate(['mode', 'ls', 'period', 'cphi', 'cg', 'norm']):
+                        blocks[key] = head[irow]
+                blocks['y'] = np.transpose(earthsr_mem.egny[:,:,:nblocks], (2,1,0))
+
+        return disp, model, blocks
+
+class read_egnfile_bin:
+
+        """ Class to read a binary eigenfunction file (see open_egnfile_bin) and extract the eigenfunctions FOR
+            ALL MODES AT A LIST OF PERIODS. Attributes are the same as those of read_egnfile_blocks.
+            infile can also be the (model, blocks) of an in-process earthsr run (see read_earthsr_mem)
+
+        NB: Blocks already hold all layers of the model, eigenfunctions keeping their last value below the
+            deepest layer of each mode, so no text is parsed and no padding is done here """
+
+        def __init__(self, infile, p_concerned_list, dtype=np.float64):
+                if isinstance(infile, str):
+                        model, blocks = open_egnfile_bin(infile)
                 else:
-                            egn_contents = open(infile,'r')
-                ncol_ph=7
-                
-                # First line in the file is a string
-                egn_contents.readline()
-                # Second line contains number of layers
-                model_deps = int(egn_contents.readline().split()[0])
-                self.dep=np.arange(model_deps,dtype=float)
-                self.mu=np.arange(model_deps,dtype=float)
-                self.lamda=np.arange(model_deps,dtype=float)
-                self.rho=np.arange(model_deps,dtype=float)
-                alpha=[ii for ii in range(model_deps)]
-                beta=[ii for ii in range(model_deps)]
-                #self.rho=range(model_deps)
-                i=0
-                j=0
-                k=0
-                startreading=False
-                cptt=0
-                
-                # Build list of eigenfunctions
-                self.totm = []
-                self.wavnum = []
-                self.uzmat = []
-                self.urmat = []
-                self.tzmat = []
-                self.trmat = []
-                self.utmat = []
-                self.ttmat = []
-                
-                done_per_list = [] # List of periods already done
-                mode_no = np.zeros((len(p_concerned_list)), dtype=int)
-                for line in egn_contents:
-                
-                        cptt=cptt+1
-                        if i < model_deps:      
-                                values_line = line.split()
-                                self.dep[i]=float(values_line[0])
-                                
-                                alpha[i]=float(values_line[3])
-                                beta[i]=float(values_line[1])
-                                self.rho[i]=float(values_line[2])
-                                self.mu[i]=self.rho[i]*(beta[i]**2)
-                                self.lamda[i]=self.rho[i]*(alpha[i]**2)-(2*self.mu[i])
-                                i+=1
-                                
-                        if "modes listed" in line:
-                                self.totm = int(line.split()[0]) 
-                                for l in range(0, len(p_concerned_list)):
-                                        self.wavnum.append( np.zeros(self.totm) )
-                                        self.uzmat.append( np.zeros((model_deps,self.totm)) )
-                                        self.urmat.append( np.zeros((model_deps,self.totm)) )
-                                        self.tzmat.append( np.zeros((model_deps,self.totm)) )
-                                        self.trmat.append( np.zeros((model_deps,self.totm)) )
-                                        self.utmat.append( np.zeros((model_deps,self.totm)) )
-                                        self.ttmat.append( np.zeros((model_deps,self.totm)) )
-                                
-                                # setup toolbar
-                                cptbar        = 0
-                                toolbar_width = 40//Nproc
-                                total_length  = len(p_concerned_list) * self.totm
-                                #sys.stdout.write("Building eigenfunctions: [%s]" % (" " * toolbar_width))
-                                #sys.stdout.flush()
-                                sys.stdout.write("\b" * (toolbar_width+1)) # return to start of line, after '['
-                        
-                        if startreading:
-                        
-                                try:
-                                        if( len(line.split()[1].split('+')) > 1 and False):
-                                                exponent = int(line.split()[1].split('+')[-1])
-                                                if exponent > 10:
-                                                        values_line = [ np.nan for i in line.split() ]
-                                                        values_line[0] = float(line.split()[0])
-                                                else:
-                                                        values_line = [ float(i) for i in line.split() ]
-                                        else:
-                                                values_line = [ float(i) for i in line.split() ]
-                                except:
-                                        bp()
-                                         
-                                y1[j]=values_line[1]
-                                y2[j]=values_line[2]
-                                
-                                try:
-                                        y3[j]=values_line[3]
-                                        y4[j]=values_line[4]
-                                        isray=True
-                                        islov=False
-                                except IndexError:
-                                        islov=True
-                                        isray=False
-                                        
-                                j+=1
-                                if j==lyrsthism:
-                                        startreading=False
-                                        if isray:
-                                                self.uzmat[iper][:len(y1),k]=y1
-                                                self.urmat[iper][:len(y2),k]=y2
-                                                self.tzmat[iper][:len(y3),k]=y3
-                                                self.trmat[iper][:len(y4),k]=y4
-                                                
-                                                self.uzmat[iper][len(y1):len(self.uzmat[-1][:,k]),k]=y1[len(y1)-1]
-                                                self.urmat[iper][len(y2):len(self.urmat[-1][:,k]),k]=y2[len(y2)-1]
-                                                self.tzmat[iper][len(y3):len(self.tzmat[-1][:,k]),k]=y3[len(y3)-1]
-                                                self.trmat[iper][len(y4):len(self.trmat[-1][:,k]),k]=y4[len(y4)-1]
-                                                
-                                                self.utmat[iper]=None
-                                                self.ttmat[iper]=None
-                                        elif islov:
-                                                self.utmat[iper][:len(y1),k]=y1
-                                                self.ttmat[iper][:len(y2),k]=y2
-                                                self.uzmat[iper]=None
-                                                self.urmat[iper]=None
-                                                self.tzmat[iper]=None
-                                                self.trmat[iper]=None
-                                        #k+=1
-
-                        if (len(line.split())==ncol_ph) and (not line.split()[0].isalpha()):
-                        
-                                perto5th=round(float(line.split()[1]),5)
-                                perto7th=round(float(line.split()[1]),7)
-                                p_concerned_5th  = [round(p_temp,5) for p_temp in p_concerned_list]
-                                p_concerned_6th  = [round(round(p_temp,6),5) for p_temp in p_concerned_list]
-                                p_concerned_7th  = [round(p_temp,7) for p_temp in p_concerned_list]
-                                p_concerned_trunc = [truncate(p_temp,5) for p_temp in p_concerned_list]
-                                saveline = line
-                                
-                                if ( (perto5th in p_concerned_5th \
-                                        or perto5th in p_concerned_6th \
-                                        or perto5th in p_concerned_trunc \
-                                        or perto7th in p_concerned_7th) ):
-                                        
-                                        ## If the "done list" already contains a period that we already went through, we reset
-                                        if( perto7th in done_per_list ):
-                                                k += 1
-                                                done_per_list = []
-                                                
-                                        done_per_list.append( perto7th )
-                                                
-                                        iper = len(done_per_list) - 1
-                                        mode_no[iper] += 1
-                                        
-                                #if perto5th==round(round(p_concerned,6),5) or perto5th==round(p_concerned,5) \
-                                #        or perto7th==round(p_concerned,7) or perto5th==truncate(p_concerned,5):
-                                
-                                        if __name__=='__main__':
-                                                print( "Extracting eigenfunction for mode %d and period %.6f" %(int(line.split()[0]),float(line.split()[1])))
-                                        j=0
-                                        #self.wavnum[k]=2*np.pi/(p_concerned*float(line.split()[2]))
-                                        self.wavnum[iper][k]=2*np.pi/(perto7th*float(line.split()[2]))
-                                        lyrsthism=int(line.split()[5])
-                                        startreading=True
-                                        save_mode=int(line.split()[0])
-                                        y1=np.arange(lyrsthism,dtype=float)
-                                        y2=np.arange(lyrsthism,dtype=float)
-                                        y3=np.arange(lyrsthism,dtype=float)
-                                        y4=np.arange(lyrsthism,dtype=float)
-                                        
-                                        if(int(toolbar_width*(k* len(p_concerned_list) + iper + 1)/total_length) > cptbar):
-                                                cptbar = int(toolbar_width*(k* len(p_concerned_list) + iper + 1)/total_length)
-                                                sys.stdout.write("-")
-                                                sys.stdout.flush()
-                
-                # At this stage, i.e. after the entire file has been read, the value of k will be equal to the number
-                # of modes that exist (are present in the file) for the given period. The matrices containing the 
-                # eigenfunctions (each column of matrix = separate mode) should therefore be trimmed down to k
-                # columns. This is done by the function final_result
-                #sys.stdout.write("] Done\n")
-                try:
-                        mode_no = np.array(mode_no, dtype=int)
-                        self.final_result(mode_no,isray)
-                except:
-                        bp()
-                        
-        def final_result(self,relm,ray):
-                
-                for i in range(0, len(self.wavnum)):
-                
-                        extracols=np.arange(relm[i],self.totm)
-                
-                        self.wavnum[i]=np.delete(self.wavnum[i],extracols)
-                        if ray:
-                                self.uzmat[i]=np.delete(self.uzmat[i],extracols,1)
-                                self.urmat[i]=np.delete(self.urmat[i],extracols,1)
-                                self.tzmat[i]=np.delete(self.tzmat[i],extracols,1)
-                                self.trmat[i]=np.delete(self.trmat[i],extracols,1)
-                                
-                        else:
-                                self.utmat[i]=np.delete(self.utmat[i],extracols,1)
-                                self.ttmat[i]=np.delete(self.ttmat[i],extracols,1)
-        
+                        model, blocks = infile
+                self.dep   = model['dep']
+                self.mu    = model['mu']
+                self.lamda = model['lamda']
+                self.rho   = model['rho']
+                model_deps = len(self.dep)
+                ncomp      = blocks.dtype['y'].shape[1]
+
+                # Columns follow the order in which modes appear in the file
+                modes, cols = np.unique(blocks['mode'], return_inverse=True)
+                p_index  = period_index(p_concerned_list)
+                per_ids  = [[] for p_temp in p_concerned_list]
+                for iblock, period in enumerate(blocks['period'].tolist()):
+                        iper = p_index.exact(period)
+                        if iper is not None:
+                                per_ids[iper].append( iblock )
+
+                self.nmodes = np.array([cols[ids].max() + 1 if ids else 0 for ids in per_ids], dtype=int)
+                totm = self.nmodes.max() if self.nmodes.size else 0
+
+                self.wavnum = np.zeros((len(per_ids),totm))
+                ymat = np.zeros((ncomp,len(per_ids),model_deps,totm), dtype=dtype)
+                for iper, ids in enumerate(per_ids):
+                        if ids:
+                                self.wavnum[iper,cols[ids]] = 2*np.pi/(blocks['period'][ids]*blocks['cphi'][ids])
+                                ymat[:,iper][:,:,cols[ids]] = np.transpose(blocks['y'][ids], (2,1,0))
+
+                set_egnfile_components(self, ymat)
+
+####################################################################################################################
+
+# Arrays of a parsed eigenfunction file stored in the cache: model arrays, and (period, ..., mode) arrays whose
+# periods are stacked and whose modes are padded to the largest number of modes
+egn_cache_model  = ['dep', 'mu', 'lamda', 'rho']
+egn_cache_period = ['wavnum', 'uzmat', 'urmat', 'tzmat', 'trmat']
+
+def egn_cache_key(earthsr_input, p_concerned_list, dtype=np.float64):
+
+        """ Hash of the earthsr input file (model, frequencies, modes), of the periods read from the eigen
+            file and of the storage type of eigenfunctions, used as the name of a cache entry
+        """
+
+        key = hashlib.sha1()
+        with open(earthsr_input, 'rb') as f:
+                key.update(f.read())
+        key.update(np.asarray(p_concerned_list, dtype=float).tobytes())
+        key.update(np.dtype(dtype).str.encode())
+
+        return key.hexdigest()
+
+def save_egn_cache(folder, reoobjs):
+
+        """ Writes the eigenfunctions read by a list of read_egnfile_blocks objects (one per group of periods)
+            to folder as .npy files that read_egn_cache can memory-map. The entry is written in a temporary
+            folder first so that concurrent runs never see a partial entry
+        """
+
+        # Only Rayleigh eigenfunctions are cached
+        if any([reoobj.uzmat is None for reoobj in reoobjs]):
+                return
+
+        nmodes = np.concatenate([reoobj.nmodes for reoobj in reoobjs])
+        totm   = nmodes.max() if nmodes.size else 0
+
+        folder_tmp = folder.rstrip('/') + '.tmp' + str(os.getpid())
+        os.makedirs(folder_tmp)
+        for name in egn_cache_model:
+                np.save(os.path.join(folder_tmp, name + '.npy'), getattr(reoobjs[0], name))
+        np.save(os.path.join(folder_tmp, 'nmodes.npy'), nmodes)
+        for name in egn_cache_period:
+                mats  = [getattr(reoobj, name) for reoobj in reoobjs]
+                shape = (nmodes.size,) + mats[0].shape[1:-1] + (totm,)
+                stack = np.lib.format.open_memmap(os.path.join(folder_tmp, name + '.npy'), mode='w+', dtype=mats[0].dtype, shape=shape)
+                iper  = 0
+                for mat in mats:
+                        stack[iper:iper+mat.shape[0], ..., :mat.shape[-1]] = mat
+                        stack[iper:iper+mat.shape[0], ..., mat.shape[-1]:] = 0.
+                        iper += mat.shape[0]
+                stack.flush()
+                del stack
+
+        try:
+                os.rename(folder_tmp, folder)
+        except OSError:
+                # Another run stored the same entry in the meantime
+                shutil.rmtree(folder_tmp)
+
+class read_egn_cache:
+
+        """ Class to load eigenfunctions stored by save_egn_cache. Arrays are memory-mapped, so nothing is read
+            until used. The attributes are the same as those of read_egnfile_blocks
+        """
+
+        def __init__(self, folder):
+
+                for name in egn_cache_model + egn_cache_period + ['nmodes']:
+                        setattr(self, name, np.load(os.path.join(folder, name + '.npy'), mmap_mode='r'))
+                self.utmat = None
+                self.ttmat = None
+
 ####################################################################################################################
 
 class read_disp:
@@ -729,7 +906,7 @@ class read_disp:
                 if int1==None and int2==None:
                         # operation 3 - read flattened model
                         self.getfmod=True
-                        self.fstruc=range(len(flist))
+                        self.fstruc=[None]*len(flist)
                         for fn,fl in enumerate(flist):
                                 self.fstruc[fn]=self.read_single_file(fl)
                                 print( "Finished reading file: ", fl)
@@ -738,7 +915,7 @@ class read_disp:
                         self.getpd=True
                         self.mnum=int1
                         self.psec=int2
-                        self.modpd=range(len(flist))
+                        self.modpd=[None]*len(flist)
                         for fn,fl in enumerate(flist):
                                 self.modpd[fn]=self.read_single_file(fl)
                                 print( "Finished reading file: ", fl)
@@ -747,8 +924,8 @@ class read_disp:
                         self.getdisp=True
                         self.mode_l = int1
                         self.mode_h = int2
-                        self.modcdisp=range(len(flist))
-                        self.modudisp=range(len(flist))
+                        self.modcdisp=[None]*len(flist)
+                        self.modudisp=[None]*len(flist)
                         for fn,fl in enumerate(flist):
                                 try:
                                         [self.modcdisp[fn],self.modudisp[fn]]=self.read_single_file(fl)
@@ -763,7 +940,7 @@ class read_disp:
                 self.ncol_ph=8
                 if self.getpd:
                         self.parse_filepd(indfile)
-                        return zip(self.deporig,self.reqdpd)
+                        return list(zip(self.deporig,self.reqdpd))
                 elif self.getdisp:
                         self.tlm=[]        # tlm stands for Total_Lines_Mode - total lines in file before the end of any mode
                         self.parse_filedisp(indfile)
@@ -777,101 +954,75 @@ class read_disp:
                         #                self.extra_analysis(cdisp)
                 elif self.getfmod:
                         self.parse_filepd(indfile,True)
-                        return zip(self.depf,self.vsf)
+                        return list(zip(self.depf,self.vsf))
+
+        def is_period_header(self,line):
+
+                """ True for the period header lines listing mode, period, c, U, ... in the disp file """
+
+                line_split=line.split()
+                return len(line_split)==self.ncol_ph and line_split[0].isdigit()
 
         def parse_filepd(self,disp_file,modonly=False):
 
                 """ Reads the file to extract partial derivatives for the required mode & period.
-                    Stops reading once it has found the right mode-period combination and read in
-                    all its partial derivatives
+                    The file is read into memory at once and each block of numbers (original model,
+                    flattened model, partial derivatives) is converted in a single call
                 """
 
                 if disp_file.endswith('.gz'):
-                            disp_contents = gzip.GzipFile(disp_file,'r')
+                            disp_contents = gzip.open(disp_file,'rt')
                 else:
                             disp_contents = open(disp_file,'r')
-                
-                pd_one_par=[]
-                pd_par=[]
-                npar=int(disp_contents.readline().split()[0])
-                nlo=int(disp_contents.readline().split()[0])
+                disp_entire=disp_contents.readlines()
+                disp_contents.close()
+                del disp_contents
+
+                npar=int(disp_entire[0].split()[0])
+                nlo=int(disp_entire[1].split()[0])
                 # Second line contains num. of layers in original model
                 
                 # Number of columns in file for the period headers, and number of model parameters
                 # w.r.t which partial derivatives are present in the file, need to be known before-hand
                 
-                self.deporig=[0.0]
-                self.depf=[0.0] 
-                self.vsf=[]
-                cl=0
-                pardone=0
-                mainreading=False
-                foundtarget=False
-                for line in disp_contents:
-                        if not mainreading:
-                                if cl<nlo:
-                                        thk=float(line.split()[0])
-                                        self.deporig.append(self.deporig[-1]+thk)
-                                        cl+=1                
-                                else:
-                                        try:
-                                                thk_fltnd=float(line.split()[0])
-                                                vs_fltnd=float(line.split()[-1])
-                                                self.vsf.append(vs_fltnd)
-                                                try:
-                                                        #self.depf[cl-nlo]=self.depf[cl-nlo-1]+thk_fltnd
-                                                        self.depf.append(self.depf[-1]+thk_fltnd)
-                                                        cl+=1
-                                                except IndexError:
-                                                        pass
-                                        except (IndexError, ValueError):
-                                                pass
-                                        if "modes listed" in line:
-                                                mainreading=True
-                                                if modonly:
-                                                        return
-                                                        print("returning now!")
-                        else:
-                                if foundtarget:
-                                        if pardone==npar:
-                                                break
-                                        else:
-                                                if (len(line.split())==self.ncol_ph and line.split()[0].isdigit()):
-                                                        sys.exit('Partial derivatives for period %d not listed in file' %(self.psec))
-                                                values_on_line = [ float(i) for i in line.split() ]
-                                                pd_one_par.extend(values_on_line)
-                                                if len(pd_one_par)==depsthismp:
-                                                        pd_par.append(np.array(pd_one_par))
-                                                        pd_one_par=[]
-                                                        pardone+=1
-                                else:
-                                        if (len(line.split())==self.ncol_ph): #and ("mode" not in line.split()):
-                                                # on a period header line
-                                                try:
-                                                        perto5th=round(float(line.split()[1]),5)
-                                                except ValueError:
-                                                        print( "problem with line: ", line)
-                                                        sys.exit()
-                                                if (int(line.split()[0])==self.mnum) and (perto5th==self.psec):
-                                                        foundtarget=True
-                                                        depsthismp=int(line.split()[-2])
-                                                        pardone=0
-                                                else:
-                                                        continue
-                                        else:
-                                                continue
-                # out of for loop
-                if len(pd_par)==0:
+                thk=np.array([float(line.split()[0]) for line in disp_entire[2:2+nlo]])
+                self.deporig=np.concatenate([[0.0], np.cumsum(thk)])
+
+                # Flattened model, in between the original model and the "modes listed" line
+                ilisted=[i for i,line in enumerate(disp_entire) if "modes listed" in line][0]
+                fmod_lines=[line for line in disp_entire[2+nlo:ilisted] if line.strip() and "flattened" not in line]
+                fmod=np.fromstring(''.join(fmod_lines), sep=' ')
+                if fmod_lines:
+                        fmod=fmod.reshape(len(fmod_lines), -1)
+                        self.vsf=fmod[:,-1]
+                        self.depf=np.concatenate([[0.0], np.cumsum(fmod[:,0])])
+                else:
+                        self.vsf=np.array([])
+                        self.depf=np.array([0.0])
+                if modonly:
+                        return
+
+                disp_entire=disp_entire[ilisted+1:]
+                headers=[i for i,line in enumerate(disp_entire) if self.is_period_header(line)]
+                target=[i for i in headers if int(disp_entire[i].split()[0])==self.mnum and round(float(disp_entire[i].split()[1]),5)==self.psec]
+                if len(target)==0:
                         sys.exit('Period %d not listed in file' %(self.psec))
-                print( "Extracted partial derviatives for %d parameters" %(len(pd_par)))
-                pd_all=np.zeros((nlo,len(pd_par)))
-                for col,par in enumerate(pd_par):
-                        pd_all[:len(par),col]=par
-                #print len(self.deporig), len(self.depf), self.vsf
-                #print pd_par, pd_all
+                itarget=target[0]
+                depsthismp=int(disp_entire[itarget].split()[-2])
+
+                # Partial derivatives run until the next period header or end of mode
+                iend=itarget+1
+                while iend<len(disp_entire) and not (self.is_period_header(disp_entire[iend]) or "****" in disp_entire[iend]):
+                        iend+=1
+                pd_values=np.fromstring(''.join(disp_entire[itarget+1:iend]), sep=' ')
+                if pd_values.size<npar*depsthismp:
+                        sys.exit('Partial derivatives for period %d not listed in file' %(self.psec))
+                pd_par=pd_values[:npar*depsthismp].reshape(npar, depsthismp)
+                print( "Extracted partial derviatives for %d parameters" %(npar))
+                pd_all=np.zeros((nlo,npar))
+                ndep=min(nlo,depsthismp)
+                pd_all[:ndep,:]=pd_par[:,:ndep].T
                 self.reqdpd=pd_all[:,2]
-                disp_contents.close()
-                del disp_contents
 
         def parse_filedisp(self,disp_file):
 
@@ -879,12 +1030,14 @@ class read_disp:
                 """
 
                 if disp_file.endswith('.gz'):
-                            disp_contents = gzip.GzipFile(disp_file,'r')
+                            disp_contents = gzip.open(disp_file,'rt')
                 else:
                             disp_contents = open(disp_file,'r')
                 
                 # Read the file into memory but get rid of the initial model-specifying part
                 disp_entire=disp_contents.readlines()
+                disp_contents.close()
+                del disp_contents
                 if "SURF96" in disp_entire[0]:
                         # this file is produced by surf96
                         return
@@ -896,55 +1049,27 @@ class read_disp:
                                 break
                 self.whole_disp = disp_entire[i+1:]        
                 
-                # Get the period samples and number of lines for each mode
-                per_linescounter=0
-                #ps_mode=[]
-                for line in self.whole_disp:
-                        per_linescounter+=1
-                        if "****" in line:
-                                self.tlm.append(per_linescounter)
-                                per_counter=0        
-                disp_contents.close()
-                del disp_contents
+                # Number of lines read at the end of each mode
+                self.tlm=[iline+1 for iline,line in enumerate(self.whole_disp) if "****" in line]
 
         def pick_right_slice(self):
                 
-                all_modes = range(len(self.tlm))
-                try:
-                        prev_lines = [ self.tlm[x] for x,y in enumerate(all_modes) if y<self.mode_l ][-1]
-                except IndexError:
-                        prev_lines = 0
-                last_rel_line = [ self.tlm[x] for x,y in enumerate(all_modes) if y>=self.mode_l and y <= self.mode_h ][-1]
-                self.rel_modes = range(self.mode_l,self.mode_h+1)
-                rel_slice = self.whole_disp[prev_lines:last_rel_line]
-                #print self.tlm
+                prev_lines = self.tlm[self.mode_l-1] if 0 < self.mode_l <= len(self.tlm) else 0
+                last_rel_line = self.tlm[min(self.mode_h,len(self.tlm)-1)]
+                self.rel_modes = list(range(self.mode_l,self.mode_h+1))
                 print( "Reading between lines %d and %d " %(prev_lines, last_rel_line))
-                pvd=range(len(self.rel_modes)) # pvd stands for phase velocity dispersion
-                gvd=range(len(self.rel_modes)) # gvd stands for group velocity dispersion
-                pv=[]
-                gv=[]
-                freq=[]
-                mdone=0
-                for line in rel_slice:
-                        if "****" in line:
-                                try:
-                                        pvd[mdone]=zip(freq,pv)
-                                except IndexError:
-                                        break
-                                gvd[mdone]=zip(freq,gv)
-                                print( "Finished reading dispersion of mode ", self.rel_modes[mdone])
-                                mdone+=1
-                                pv=[]
-                                gv=[]
-                                freq=[]
-                        else:
-                                if (len(line.split())==self.ncol_ph) and (line.split()[0].isdigit()) and (line.split()[-1].isdigit()):
-                                        values_line = [ i for i in line.split() ]
-                                        #print values_line
-                                        freq_temp = '%.4f' %(1./float(values_line[1]))
-                                        freq.append(float(freq_temp))
-                                        pv.append(float(values_line[2]))
-                                        gv.append(float(values_line[3]))
+                pvd=[None]*len(self.rel_modes) # pvd stands for phase velocity dispersion
+                gvd=[None]*len(self.rel_modes) # gvd stands for group velocity dispersion
+                start=prev_lines
+                for mdone,end in enumerate(self.tlm[self.mode_l:self.mode_h+1]):
+                        # Period lines of this mode, converted in a single call
+                        per_lines=[line for line in self.whole_disp[start:end-1] if self.is_period_header(line) and line.split()[-1].isdigit()]
+                        values=np.fromstring(''.join(per_lines), sep=' ').reshape(len(per_lines), self.ncol_ph)
+                        freq=np.round(1./values[:,1], 4)
+                        pvd[mdone]=list(zip(freq,values[:,2]))
+                        gvd[mdone]=list(zip(freq,values[:,3]))
+                        print( "Finished reading dispersion of mode ", self.rel_modes[mdone])
+                        start=end
                 return pvd,gvd
                         
 ####################################################################################################################
@@ -984,6 +1109,105 @@ class read_excitation:
                 
 ####################################################################################################################
 
+def read_fortran_record(buf, pos, dtype):
+
+        """ Reads the sequential unformatted Fortran record starting at byte pos of buf, assuming 4-byte
+            little-endian record markers (gfortran default). Returns the record as an array of dtype and the
+            position of the next record
+        """
+
+        dtype  = np.dtype(dtype)
+        length = int(np.frombuffer(buf, dtype='<i4', count=1, offset=pos)[0])
+        if length % dtype.itemsize or length != int(np.frombuffer(buf, dtype='<i4', count=1, offset=pos+4+length)[0]):
+                sys.exit('Corrupted Fortran record at byte %d' % (pos))
+        record = np.frombuffer(buf, dtype=dtype, count=length//dtype.itemsize, offset=pos+4)
+        return record, pos+length+8
+
+class read_binfile:
+
+        """ Class to read the unformatted file that earthsr writes on unit iouf1 (named 'ray' by
+            generate_model_for_earthsr). For each mode, and each frequency at which this mode exists, earthsr
+            writes the angular frequency, phase velocity and attenuation, the eigenfunctions and stress terms at
+            the receiver depth, and the excitation terms at each source depth
+
+            Attributes other than the header (nsrce, nom, df, jcom, nbran, sdep) are lists with one entry per mode:
+            mode, omega, period, cphi, wavnum, gam, uz and ur (Rayleigh) or ut (Love) at the receiver, gb1, gb2
+            (Rayleigh only, None otherwise) and py, an array (frequencies, sources, 3 for Rayleigh or 2 for Love)
+            of excitation terms. Frequencies are in the order of the file (decreasing)
+
+        NB: The whole file is read with a handful of numpy calls since all frequency records of a mode have the
+            same size. The start frequency of the header is not initialised by earthsr and is not returned """
+
+        def __init__(self, infile):
+                with open(infile, 'rb') as f:
+                        buf = f.read()
+
+                header_dtype = [('nsrce', '<i4'), ('nom', '<i4'), ('df', '<f8'), ('f0', '<f8'), ('jcom', '<i4'), ('nbran', '<i4')]
+                header, pos = read_fortran_record(buf, 0, header_dtype)
+                self.nsrce = int(header['nsrce'][0])
+                self.nom   = int(header['nom'][0])
+                self.df    = float(header['df'][0])
+                self.jcom  = int(header['jcom'][0])
+                self.nbran = int(header['nbran'][0])
+                self.sdep, pos = read_fortran_record(buf, pos, '<f8')
+                isray = self.jcom == 1
+
+                # One frequency: [w, cc, gam, x(1), x(2), gb1, gb2] (Rayleigh) or [w, cc, gam, x(1), gb1] (Love),
+                # followed by one record of excitation terms per source
+                nval = 7 if isray else 5
+                npy  = 3 if isray else 2
+                py_dtype   = np.dtype([('m0', '<i4'), ('val', '<f8', (npy,)), ('m1', '<i4')])
+                freq_dtype = np.dtype([('m0', '<i4'), ('val', '<f8', (nval,)), ('m1', '<i4'), ('py', py_dtype, (self.nsrce,))])
+
+                self.mode = []
+                self.omega = []
+                self.period = []
+                self.cphi = []
+                self.wavnum = []
+                self.gam = []
+                self.uz = []
+                self.ur = []
+                self.ut = []
+                self.gb1 = []
+                self.gb2 = []
+                self.py = []
+                while pos < len(buf):
+                        nb, pos = read_fortran_record(buf, pos, '<i4')
+
+                        # Frequency records are followed by istop, whose marker differs from theirs
+                        nmax    = (len(buf) - pos) // freq_dtype.itemsize
+                        markers = np.ndarray((nmax,), dtype='<i4', buffer=buf, offset=pos, strides=(freq_dtype.itemsize,))
+                        notfreq = np.flatnonzero(markers != 8*nval)
+                        nfreq   = notfreq[0] if notfreq.size else nmax
+                        freqs   = np.frombuffer(buf, dtype=freq_dtype, count=nfreq, offset=pos)
+                        pos    += nfreq*freq_dtype.itemsize
+                        istop, pos = read_fortran_record(buf, pos, '<i4')
+                        if istop[0] != -1:
+                                sys.exit('Unexpected end of mode %d in %s' % (nb[0], infile))
+
+                        val = freqs['val']
+                        self.mode.append( int(nb[0]) )
+                        self.omega.append( val[:,0] )
+                        self.period.append( 2*np.pi/val[:,0] )
+                        self.cphi.append( val[:,1] )
+                        self.wavnum.append( val[:,0]/val[:,1] )
+                        self.gam.append( val[:,2] )
+                        self.py.append( freqs['py']['val'] )
+                        if isray:
+                                self.uz.append( val[:,3] )
+                                self.ur.append( val[:,4] )
+                                self.ut.append( None )
+                                self.gb1.append( val[:,5] )
+                                self.gb2.append( val[:,6] )
+                        else:
+                                self.uz.append( None )
+                                self.ur.append( None )
+                                self.ut.append( val[:,3] )
+                                self.gb1.append( val[:,4] )
+                                self.gb2.append( None )
+
+####################################################################################################################
+
 """ If running this module as a script by itself, it produces a plot of the eigenfunctions of a particular mode 
     at a particular period or a plot of phase or group velocity dispersion for a set of specified modes, or of the
     excitation amplitudes of all modes at a particular frequency
@@ -93,8 +93,15 @@ def determine_folders(options):
                 
         name_simu_folder = './coefs_batch_' + str(nbdirs+1) + '/'
         
+        ## Folder creation fails if a concurrent run took this number first, the next one is tried then
         if(options['PLOT'] < 2):
-                os.makedirs(name_simu_folder)
+                while True:
+                        try:
+                                os.makedirs(name_simu_folder)
+                                break
+                        except FileExistsError:
+                                nbdirs += 1
+                                name_simu_folder = './coefs_batch_' + str(nbdirs+1) + '/'
                 
         options_loc['name_simu_subfolder'] = ''
         options_loc['global_folder']       = name_simu_folder + options_loc['name_simu_subfolder']
@@ -105,6 +112,15 @@ def load(file_name, delimiter = ' '):
 
     file_r = open(file_name, 'r') 
     data   = file_r.readlines() 
+    file_r.close()
+    
+    ## Whitespace-separated table with the same number of columns on each line: converted in a single call
+    if delimiter == ' ' and data:
+            ncol = len(data[0].split())
+            nrow = len([line for line in data if line.strip()])
+            data_array = np.fromstring(''.join(data), sep=' ')
+            if ncol > 0 and data_array.size == nrow*ncol:
+                    return data_array.reshape(nrow, ncol)
     
     data_array = []
     for line in data:
@@ -154,7 +154,7 @@ def create_velocity_model(options):
 
 def create_velocity_figures(current_struct, options):
 
-        nbmodes = np.sum([1 for key in current_struct if key])
+        nbmodes = int(np.sum(current_struct.valid.any(axis=1)))
         fig, axs = plt.subplots(nrows=nbmodes, ncols=1, sharex=True, sharey=True)
         
         if nbmodes == 1:
@@ -164,15 +164,16 @@ def create_velocity_figures(current_struct, options):
         
         selected_axs.set_ylabel('Velocity (km/s)')
         selected_axs.set_xlabel('Frequency (Hz)')
-        fks = current_struct[0]['fks']
+        fks = current_struct.fks[0, current_struct.valid[0]]
         selected_axs.set_xlim([fks.min(), fks.max()])
         for imode in range(0, nbmodes):
                 
                 if nbmodes > 1:
                         selected_axs = axs[imode]
         
-                selected_axs.plot(current_struct[imode]['fks'], current_struct[imode]['cphi'], label='$c_\Phi$')
-                selected_axs.plot(current_struct[imode]['fks'], current_struct[imode]['cg'], label='$c_g$', linestyle='--')
+                valid = current_struct.valid[imode]
+                selected_axs.plot(current_struct.fks[imode, valid], current_struct.cphi[imode, valid], label='$c_\Phi$')
+                selected_axs.plot(current_struct.fks[imode, valid], current_struct.cg[imode, valid], label='$c_g$', linestyle='--')
                 selected_axs.grid()
                 selected_axs.text(0.5, 1., 'Mode '+str(imode), horizontalalignment='center', verticalalignment='center', bbox=dict(facecolor='w', edgecolor='black', pad=4.0), transform=selected_axs.transAxes)
                 selected_axs.set_xscale('log')
@@ -190,7 +191,13 @@ def create_velocity_figures(current_struct, options):
 def discretize_model_heterogeneous(data, options): 
 
         ## Build interpolated depth model
-        z_interp = np.linspace(options['z'][0], options['zmax'], options['nb_layers'])
+        ## Layers following the wavelengths take the properties at their centre, so that the model interfaces are kept
+        if options['layer_wavelength_fraction'] > 0:
+                z_interp = wavelength_layers(data[options['chosen_model']], options)
+                z_eval   = np.append(0.5*(z_interp[:-1] + z_interp[1:]), z_interp[-1])
+        else:
+                z_interp = np.linspace(options['z'][0], options['zmax'], options['nb_layers'])
+                z_eval   = z_interp
         z_interp_interm = np.linspace(options['z'][0], options['z'][-1], 400)
 
         ## Loop over models (CVMH/CVMS) and unknowns (rho/vs/vp)
@@ -217,11 +224,39 @@ def discretize_model_heterogeneous(data, options):
                         #data_interp[imodel][iunknown] = f(z_interp)
                         
                         f    = interpolate.interp1d(options['z'], temp, kind='next')
-                        temp_interm = f(z_interp)/1000.
+                        temp_interm = f(z_eval)/1000.
                         
                         data_interp[imodel][iunknown] = temp_interm
         
         return z_interp, data_interp
+
+## Layer tops (m) for discretize_model_heterogeneous. Each layer of the model is split into layers thinner than
+## options['layer_wavelength_fraction'] times the shortest shear wavelength in it (P wavelength in fluids), at the highest frequency
+## The model stops at options['layer_depth_wavelengths'] times the longest wavelength at the lowest frequency, or at options['zmax']
+def wavelength_layers(model, options):
+
+        velocity = {}
+        for iunknown in ['vs', 'vp']:
+                velocity[iunknown] = np.array(model[iunknown], dtype=float)
+                locnan = np.isnan(velocity[iunknown]).nonzero()[0]
+                if( locnan.size > 0 ):
+                        velocity[iunknown][locnan[0]:] = velocity[iunknown][locnan[0]-1]
+        v = np.where(velocity['vs'] > 0., velocity['vs'], velocity['vp'])
+        
+        z     = options['z']
+        f_tab = np.sort(options['f_tab'])
+        zmax  = min(options['zmax'], options['layer_depth_wavelengths']*v.max()/f_tab[0])
+        
+        interfaces = np.unique(np.concatenate([z[z < zmax], [zmax]]))
+        z_layers   = []
+        for ztop, zbottom in zip(interfaces[:-1], interfaces[1:]):
+                
+                ## Same convention as the interpolation of discretize_model_heterogeneous: a layer takes the next value of the model
+                v_layer = v[min(np.searchsorted(z, 0.5*(ztop + zbottom)), len(z)-1)]
+                nb      = int(np.ceil( (zbottom - ztop)/(options['layer_wavelength_fraction']*v_layer/f_tab[-1]) ))
+                z_layers.append( np.linspace(ztop, zbottom, max(nb, 1), endpoint=False) )
+        
+        return np.append(np.concatenate(z_layers), zmax)
         
 def generate_default_atmos():
         